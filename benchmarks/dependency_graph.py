@@ -0,0 +1,89 @@
+"""Times planning and calculation of a pipeline run on synthetic deep and wide feature DAGs.
+
+Usage: python -m benchmarks.dependency_graph [--depth N] [--width N] [--layers N]
+"""
+import argparse, datetime, time
+
+import pytz
+
+from pipeline_manager import PipelineManager
+from pipeline_manager.readers import Reader
+from pipeline_manager.writers import Writer
+
+
+class SyntheticReader(Reader):
+    """Returns one sample per minute for every raw source."""
+
+    def __init__(self):
+        super().__init__()
+        self.location_id = 'benchmark'
+
+    def query(self, source_id, start_time, end_time):
+        timestamp = (int(start_time) // 60 + 1) * 60
+        self.add_entries(source_id, [(t, 60, t % 100) for t in range(timestamp, int(end_time) + 1, 60)])
+
+
+def average(timestamp, timestep, inputs):
+    values = [entry[2] for entries in inputs.values() for entry in entries]
+    return [(timestamp, timestep, sum(values) / len(values) if values else 0)]
+
+
+def deep_chain(depth):
+    """Every feature depends on the previous one, down to a single raw source."""
+    features = {'feat_0': {'window': '1h', 'inputs': [('sens_0', '1h')], 'function': average}}
+    for i in range(1, depth):
+        features[f'feat_{i}'] = {'window': '1h', 'inputs': [(f'feat_{i - 1}', '1h')], 'function': average}
+    return features, [f'feat_{depth - 1}']
+
+
+def wide_diamonds(width, layers):
+    """Every feature of a layer depends on all features of the previous layer, so paths multiply with each layer."""
+    features = {}
+    for j in range(width):
+        features[f'feat_0_{j}'] = {'window': '1h', 'inputs': [(f'sens_{j}', '1h')], 'function': average}
+    for i in range(1, layers):
+        for j in range(width):
+            features[f'feat_{i}_{j}'] = {'window': '1h', 'inputs': [(f'feat_{i - 1}_{k}', '1h') for k in range(width)], 'function': average}
+    features['feat_out'] = {'window': '1d', 'inputs': [(f'feat_{layers - 1}_{k}', '1d') for k in range(width)], 'function': average}
+    return features, ['feat_out']
+
+
+def run(name, features, outputs):
+    pipeline = {'name': name, 'recurrence': {'period': '1d', 'offset': '0h'}, 'outputs': outputs}
+    manager = PipelineManager('benchmark', SyntheticReader(), Writer('benchmark'), pipeline, features, forced_time=pytz.utc.localize(datetime.datetime(2024, 1, 2)))
+    runtime = manager.calculate_runtime()
+
+    timings = {}
+    start = time.perf_counter()
+    manager.plan()
+    timings['plan'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    manager.generate_feature_dependency()
+    timings['feature graph'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    manager.generate_time_dependency(runtime)
+    timings['time graph'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    missing = manager.smart_request_dependencies(runtime)
+    timings['requests'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    manager.calculate_unmet(missing)
+    timings['calculation'] = time.perf_counter() - start
+
+    nodes = sum(1 for _ in missing.walk())
+    print(f"{name}: {len(features)} features, {nodes} nodes, " + ", ".join(f"{key} {value:.3f}s" for key, value in timings.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=8)
+    parser.add_argument('--layers', type=int, default=12)
+    args = parser.parse_args()
+
+    run(f"deep chain ({args.depth})", *deep_chain(args.depth))
+    run(f"wide diamonds ({args.width}x{args.layers})", *wide_diamonds(args.width, args.layers))
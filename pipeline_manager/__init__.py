@@ -1 +1,2 @@
-from .pipeline_manager import PipelineManager
\ No newline at end of file
+from .pipeline_manager import PipelineManager
+from .batch import PipelineBatch
\ No newline at end of file
@@ -0,0 +1,177 @@
+import contextlib, datetime
+
+from .utils import f_timestamp
+from .data_handler import calculate_levels
+from .readers import Reader
+from .pipeline_manager import PipelineManager
+from .plan import PipelinePlan
+
+class PipelineBatch:
+    """Runs the same pipeline for many locations, with the work of all locations done together.
+
+    The plan is compiled once. Raw data is requested level by level for all locations of a chunk at
+    once, so readers of the same class can fetch many locations in one query (`Reader.fetch_locations`),
+    and the feature windows of all locations are calculated in one pool of workers.
+
+    `reader` and `writer` are called with a location id and return the reader and the writer of the
+    location, which are entered and exited by the batch. A failure only stops its own location."""
+
+    def __init__(self, location_ids, reader, writer, pipeline, features, profiles=None, forced_time=None, verbosity=0, force_calculate=[], chunk_size=100):
+        # Every location is run once, in the given order
+        self.location_ids = list(dict.fromkeys(location_ids))
+        self.reader = reader
+        self.writer = writer
+        self.pipeline = pipeline
+        self.features = features
+        self.profiles = profiles or {}
+        self.forced_time = forced_time
+        self.verbosity = verbosity
+        self.force_calculate = force_calculate
+        # Readers, writers and graphs of a chunk of locations are kept in memory at once
+        self.chunk_size = chunk_size
+
+        self.workers = 1
+        self.processes = False
+
+    def set_workers(self, workers, processes=False):
+        """Shares one pool of workers between the locations of a chunk, see DataHandler.set_workers."""
+        self.workers = workers
+        self.processes = processes
+
+    def print(self, text, min_verbosity=1, **kwargs):
+        if self.verbosity >= min_verbosity:
+            print(text, **kwargs)
+
+    def run(self):
+        """Runs the pipeline for all locations.
+
+        Returns the outputs of the locations that succeeded and the exceptions of the ones that failed, both by location id."""
+        start_time = datetime.datetime.utcnow()
+        self.print(f"---- RUNNING PIPELINE {self.pipeline['name']} FOR {len(self.location_ids)} LOCATIONS ----", 1)
+        plan = PipelinePlan.get(self.pipeline, self.features)
+
+        results = {}
+        failures = {}
+        for i in range(0, len(self.location_ids), self.chunk_size):
+            self.run_chunk(self.location_ids[i:i + self.chunk_size], plan, results, failures)
+
+        end_time = datetime.datetime.utcnow()
+        self.print(f"{len(results)} locations done, {len(failures)} failed (execution time: {(end_time - start_time).total_seconds()})", 1)
+        return results, failures
+
+    def run_chunk(self, location_ids, plan, results, failures):
+        runs = {}
+
+        def fail(location_id, e):
+            self.print(f"LOCATION {location_id} FAILED: {e}", 1)
+            failures[location_id] = e
+            runs.pop(location_id, None)
+
+        opened = []
+        try:
+            for location_id in location_ids:
+                try:
+                    data_input = self.reader(location_id)
+                    data_input.__enter__()
+                    opened.append((location_id, data_input))
+                    data_output = self.writer(location_id)
+                    data_output.__enter__()
+                    opened.append((location_id, data_output))
+
+                    profile = self.profiles.get(location_id)
+                    manager = PipelineManager(location_id, data_input, data_output, self.pipeline, self.features,
+                                              profile=None if profile is None else dict(profile), forced_time=self.forced_time,
+                                              verbosity=self.verbosity, force_calculate=self.force_calculate)
+                    manager.begin(plan)
+                    runtime = manager.calculate_runtime()
+                    self.print(f"Calculated runtime {f_timestamp(runtime)} for location {location_id}.", 2)
+                    data_output.set_descriptor(f"{location_id}_{f_timestamp(runtime)}")
+                    runs[location_id] = (manager, manager.generate_time_dependency(runtime))
+                except Exception as e:
+                    fail(location_id, e)
+
+            self.request(runs, fail)
+            self.calculate(runs, fail)
+
+            for location_id, (manager, time_dependency) in list(runs.items()):
+                try:
+                    results[location_id] = manager.outputs(time_dependency)
+                except Exception as e:
+                    fail(location_id, e)
+        finally:
+            # Writers are exited first, so buffered outputs are flushed while the connections are still open
+            for location_id, o in reversed(opened):
+                try:
+                    o.__exit__(None, None, None)
+                except Exception as e:
+                    if location_id not in failures:
+                        results.pop(location_id, None)
+                        fail(location_id, e)
+
+    def request(self, runs, fail):
+        """Requests the dependencies of all runs a level of features at a time."""
+        levels = {location_id: manager.level_requests() for location_id, (manager, _) in runs.items()}
+        while levels:
+            requests = {}
+            for location_id, level in list(levels.items()):
+                if location_id not in runs:
+                    del levels[location_id]
+                    continue
+                try:
+                    requests[location_id] = next(level)
+                except StopIteration:
+                    del levels[location_id]
+                except Exception as e:
+                    del levels[location_id]
+                    fail(location_id, e)
+            self.fetch({location_id: r for location_id, r in requests.items() if r}, runs, fail)
+
+    def fetch(self, requests, runs, fail):
+        # Readers of the same class fetch their locations together
+        groups = {}
+        for location_id, location_requests in requests.items():
+            data_input = runs[location_id][0].data_input
+            if not data_input.is_online():
+                continue
+            key = type(data_input) if isinstance(data_input, Reader) else location_id
+            if key not in groups:
+                groups[key] = {}
+            groups[key][location_id] = location_requests
+
+        for key, group in groups.items():
+            if len(group) > 1:
+                locations = {runs[location_id][0].data_input: location_id for location_id in group}
+                failed = key.fetch_locations({data_input: group[location_id] for data_input, location_id in locations.items()})
+                if failed:
+                    self.print(f"Fetching {len(failed)} of {len(group)} locations together failed, fetching them one by one", 2)
+                group = {locations[data_input]: group[locations[data_input]] for data_input in failed}
+            # Single locations, and the locations that failed in a group, are fetched on their own
+            for location_id, location_requests in group.items():
+                try:
+                    runs[location_id][0].query_db_many(location_requests)
+                except Exception as e:
+                    fail(location_id, e)
+
+    def calculate(self, runs, fail):
+        """Calculates the unmet nodes of all runs, the same level of all locations at a time."""
+        if self.workers <= 1:
+            for location_id, (manager, time_dependency) in list(runs.items()):
+                try:
+                    manager.calculate_unmet(time_dependency)
+                except Exception as e:
+                    fail(location_id, e)
+            return
+
+        with contextlib.ExitStack() as stack:
+            levels = []
+            for location_id, (manager, time_dependency) in list(runs.items()):
+                try:
+                    stack.enter_context(manager.keep_hot(time_dependency))
+                    for depth, level in enumerate(manager.dependency_levels(time_dependency)):
+                        if depth == len(levels):
+                            levels.append([])
+                        levels[depth] += [(manager, node) for node in level]
+                except Exception as e:
+                    fail(location_id, e)
+
+            calculate_levels(levels, self.workers, self.processes, fail=lambda manager, e: fail(manager.location_id, e))
@@ -0,0 +1,208 @@
+import bisect, json, mmap, os.path, pickle, struct, sys
+from array import array
+
+from .utils import IntervalSet
+
+MAGIC = b'PMCACHE1'
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+class _Block:
+    """The entries of one source in one segment of a cache file."""
+
+    def __init__(self, view, base, info):
+        count = info['count']
+        self.timestamps = view[base + info['timestamps']:base + info['timestamps'] + 8 * count].cast('d')
+        self.timesteps = view[base + info['timesteps']:base + info['timesteps'] + 8 * count].cast('d')
+        self.kind = info['values']['kind']
+        raw = view[base + info['values']['offset']:base + info['values']['offset'] + info['values']['length']]
+        if self.kind == 'pickle':
+            # Object values are only unpickled once the source is read
+            self._raw = raw
+            self._values = None
+        else:
+            self._raw = None
+            self._values = raw.cast(self.kind)
+
+    def values(self):
+        if self._values is None:
+            self._values = pickle.loads(self._raw)
+            self._raw.release()
+        return self._values
+
+    def bounds(self, start, end):
+        lo = 0 if start is None else bisect.bisect_right(self.timestamps, start)
+        hi = len(self.timestamps) if end is None else bisect.bisect_right(self.timestamps, end)
+        return lo, hi
+
+    def range(self, start, end):
+        lo, hi = self.bounds(start, end)
+        values = self.values()[lo:hi]
+        if isinstance(values, memoryview):
+            values = values.tolist()
+        return list(zip(self.timestamps[lo:hi].tolist(), self.timesteps[lo:hi].tolist(), values))
+
+    def find(self, timestamp):
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+            return self.timestamps[i], self.timesteps[i], self.values()[i]
+        return None
+
+    def release(self):
+        for view in (self.timestamps, self.timesteps, self._raw, self._values):
+            if isinstance(view, memoryview):
+                view.release()
+
+
+class CacheFile:
+    """A binary cache of reader data, memory-mapped so only the touched sources and ranges are read.
+
+    The file starts with MAGIC followed by segments, each made of an 8-byte header length, a JSON
+    header and 8-byte aligned blocks. Every source in a segment is stored as sorted timestamp and
+    timestep arrays and either a numeric value array or a pickled list of values. The header also
+    records which intervals of each source were fetched, including intervals without any data.
+    New data is appended as a new segment; entries in later segments take precedence."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.segments = 0
+        self._sources = {}
+        self._coverage = {}
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a cache file: {filename}")
+
+        position = len(MAGIC)
+        while position < len(self._view):
+            (header_length,) = struct.unpack_from('<Q', self._map, position)
+            header = json.loads(bytes(self._view[position + 8:position + 8 + header_length]))
+            if header['byteorder'] != sys.byteorder:
+                self.close()
+                raise ValueError(f"Cache file {filename} was written on a machine with a different byte order")
+            base = _align(position + 8 + header_length)
+            for source_id, info in header['sources'].items():
+                if source_id not in self._sources:
+                    self._sources[source_id] = []
+                self._sources[source_id].append(_Block(self._view, base, info))
+            for source_id, intervals in header['coverage'].items():
+                if source_id not in self._coverage:
+                    self._coverage[source_id] = IntervalSet()
+                for start, end in intervals:
+                    self._coverage[source_id].add(start, end)
+            position = base + header['size']
+            self.segments += 1
+
+    def sources(self):
+        return list(self._sources)
+
+    def coverage(self, source_id):
+        """Returns the intervals of the source that were fetched into the cache."""
+        return self._coverage.get(source_id, IntervalSet())
+
+    def _find(self, source_id, timestamp):
+        for block in reversed(self._sources.get(source_id, [])):
+            entry = block.find(timestamp)
+            if entry is not None:
+                return entry
+        return None
+
+    def __contains__(self, item):
+        source_id, timestamp = item
+        return self._find(source_id, timestamp) is not None
+
+    def get(self, source_id, timestamp):
+        entry = self._find(source_id, timestamp)
+        if entry is None:
+            raise KeyError((source_id, timestamp))
+        return entry
+
+    def range(self, source_id, start, end):
+        """Returns the sorted entries of a source with a timestamp in the interval (start, end]."""
+        blocks = self._sources.get(source_id, [])
+        if len(blocks) == 1:
+            return blocks[0].range(start, end)
+        entries = {}
+        for block in blocks:
+            for entry in block.range(start, end):
+                entries[entry[0]] = entry
+        return [entries[timestamp] for timestamp in sorted(entries)]
+
+    def close(self):
+        for blocks in self._sources.values():
+            for block in blocks:
+                block.release()
+        self._sources = {}
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def write(filename, data, coverage=None, append=False):
+        """Writes a segment from a dict mapping source ids to iterables of entries.
+
+        `coverage` maps source ids to the fetched intervals. With `append`, the segment is added
+        to the end of an existing file instead of replacing it."""
+        sources = {}
+        blocks = []
+        offset = 0
+
+        def block(content):
+            nonlocal offset
+            blocks.append(content)
+            blocks.append(b'\0' * (_align(len(content)) - len(content)))
+            start = offset
+            offset += _align(len(content))
+            return start
+
+        for source_id, entries in data.items():
+            entries = sorted(entries, key=lambda entry: entry[0])
+            if not entries:
+                continue
+            values = [entry[2] for entry in entries]
+            if all(type(value) is float for value in values):
+                kind, content = 'd', array('d', values).tobytes()
+            elif all(type(value) is int and -2**63 <= value < 2**63 for value in values):
+                kind, content = 'q', array('q', values).tobytes()
+            else:
+                kind, content = 'pickle', pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+            sources[source_id] = {
+                'count': len(entries),
+                'timestamps': block(array('d', (entry[0] for entry in entries)).tobytes()),
+                'timesteps': block(array('d', (entry[1] for entry in entries)).tobytes()),
+                'values': {'kind': kind, 'offset': block(content), 'length': len(content)}
+            }
+
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'size': offset,
+            'sources': sources,
+            'coverage': {source_id: list(intervals) for source_id, intervals in (coverage or {}).items()}
+        }).encode()
+
+        append = append and os.path.exists(filename)
+        with open(filename, 'ab' if append else 'wb') as f:
+            if not append:
+                f.write(MAGIC)
+            position = f.tell()
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (_align(position + 8 + len(header)) - position - 8 - len(header)))
+            for content in blocks:
+                f.write(content)
+
+    @staticmethod
+    def compact(filename):
+        """Rewrites all segments of a cache file into a single one."""
+        cache = CacheFile(filename)
+        try:
+            data = {source_id: cache.range(source_id, None, None) for source_id in cache.sources()}
+            coverage = dict(cache._coverage)
+        finally:
+            cache.close()
+        CacheFile.write(filename, data, coverage)
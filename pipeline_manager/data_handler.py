@@ -1,8 +1,8 @@
 import logging
 
-import sys, traceback
+import contextlib, sys, threading, traceback
 
-from .utils import human_time, get_callable
+from .utils import human_time, get_callable, IntervalSet
 
 class DataHandler:
     
@@ -20,7 +20,7 @@ class DataHandler:
         def __str__(self):
             return f"Error calculating feature {self.source_id} for time {self.time} and window {self.window} ({repr(self.exc)}){self.desc}"
 
-    def __init__(self, location_id, data_input, data_output, features, profile={}, verbosity=0, force_calculate=[]):
+    def __init__(self, location_id, data_input, data_output, features, profile=None, verbosity=0, force_calculate=[]):
         self.location_id = location_id
 
         self.data_input = data_input
@@ -31,7 +31,8 @@ class DataHandler:
         
         self.features = features
 
-        self.profile = profile
+        # Every manager gets its own profile, load_profile must not change a shared default
+        self.profile = {} if profile is None else profile
 
         self.verbosity = verbosity
 
@@ -41,8 +42,39 @@ class DataHandler:
 
         self.load_profile()
 
+        # Calculations may run in several threads, each keeps its own current calculation and warnings
+        self._LOCAL = threading.local()
         self.current_calculation = None
 
+        self.workers = 1
+        self.processes = False
+
+    def __getstate__(self):
+        # Worker processes only calculate features, they get no access to the readers and writers
+        state = dict(self.__dict__)
+        del state['data_input'], state['data_output'], state['_LOCAL']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data_input = self.data_output = None
+        self._LOCAL = threading.local()
+
+    @property
+    def current_calculation(self):
+        return getattr(self._LOCAL, 'calculation', None)
+
+    @current_calculation.setter
+    def current_calculation(self, calculation):
+        self._LOCAL.calculation = calculation
+
+    def set_workers(self, workers, processes=False):
+        """Calculates independent features in a pool of `workers` threads, or processes with `processes`.
+
+        Feature functions run in parallel, so they must not rely on shared mutable state."""
+        self.workers = workers
+        self.processes = processes
+
     def load_profile(self):
         # Add time zone into profile if missing
         if 'timezone' not in self.profile:
@@ -67,7 +99,11 @@ class DataHandler:
                 f = f.f_back
             
         if w:
-            w.warnings.append(f"[{w.current_calculation if w.current_calculation else w.__class__}] {message}")
+            # During a calculation, warnings are collected and added in the order of the calculations
+            warnings = getattr(w._LOCAL, 'warnings', None)
+            if warnings is None:
+                warnings = w.warnings
+            warnings.append(f"[{w.current_calculation if w.current_calculation else w.__class__}] {message}")
 
     def print(self, text, min_verbosity=1, **kwargs):
         if self.verbosity >= min_verbosity:
@@ -76,11 +112,17 @@ class DataHandler:
 
     def query_db(self, source_id, start_time, end_time):
         if self.data_input.is_online():
-            return self.data_input.query(source_id, start_time, end_time)
+            # Only the parts of the interval that were not fetched before are queried
+            return self.data_input.fetch(source_id, start_time, end_time)
         else:
             # The loader is not online, all data is already loaded
             pass
 
+    def query_db_many(self, requests):
+        """Like query_db, but submits a batch of (source_id, start_time, end_time) requests at once."""
+        if self.data_input.is_online():
+            return self.data_input.fetch_many(requests)
+
     def s_type(self, source_id):
         return 'calculated' if source_id in self.features else 'raw'
 
@@ -166,63 +208,214 @@ class DataHandler:
                     
                     # time += pipeline_window
 
+    def hot_windows(self, time_dependency):
+        """Returns the intervals of each source that the unmet dependency nodes still need."""
+        windows = {}
+        visited = set()
+        queue = [time_dependency]
+        while queue:
+            node = queue.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            if not node.met:
+                for dependency in node.dependencies:
+                    if dependency.source_id not in windows:
+                        windows[dependency.source_id] = IntervalSet()
+                    windows[dependency.source_id].add(dependency.start_time, dependency.end_time)
+            queue += node.dependencies
+        return windows
+
+    def feature_window(self, source_id):
+        return human_time(self.features[source_id]['window'])
+
+    def feature_function(self, source_id):
+        return get_callable(self.features[source_id]['function'])
+
+    def calculate_feature(self, source_id, time, window, inputs):
+        """Calculates a single window of a feature, possibly in a worker thread or process.
+
+        Returns the data points, or None and the exception with its traceback, and the collected warnings."""
+        self._LOCAL.warnings = []
+        # Load the function that calculates the value
+        f = self.feature_function(source_id)
+        # Calculate the missing data point
+        self.current_calculation = f"{source_id} @ {time} ({window})"
+        try:
+            return f(time, window, inputs), None, self._LOCAL.warnings
+        except Exception as e:
+            return None, (e, traceback.format_exc()), self._LOCAL.warnings
+        finally:
+            self.current_calculation = None
+            self._LOCAL.warnings = None
+
+    def store_feature(self, source_id, time, window, inputs, result, force_store):
+        """Stores the result of calculate_feature, or the default value of the feature if it failed."""
+        data_points, error, warnings = result
+        feature = self.features[source_id]
+        self.warnings += warnings
+        if error is not None:
+            e, trace = error
+            if 'default' in feature:
+                data_points = [(time, window, feature['default'])]
+                self.current_calculation = f"{source_id} @ {time} ({window})"
+                DataHandler.warning(f"Used default value!")
+                self.current_calculation = None
+            else:
+                raise DataHandler.FeatureCalculationError(source_id, time, window, inputs, e, desc=f"\n{trace}")
+
+        self.print(f"Feature {source_id} calculated for {time}.", 4)
+
+        # Make a JSON for storing into the database
+        #j_point = self.make_json(source_id, end_time, timestep, data_point)
+        #self.print(j_point, 5)
+        if feature.get('store', False) or source_id in force_store:
+            # Some values may not need to be stored into the database
+            self.print(f"Storing feature {source_id} into the database.", 4)  
+            self.data_output.add_entries(source_id, data_points)
+
+        # All values are stored into the cache, so repeated lookups into
+        # the database are not necessary
+        self.print(f"Storing feature {source_id} into the cache.", 4)  
+        self.data_input.add_entries(source_id, data_points)
+
+    def windows(self, dependency_node):
+        """Yields the end times and the window of the calculations of a node."""
+        start_time, end_time = dependency_node.start_time, dependency_node.end_time
+        window = self.feature_window(dependency_node.source_id)
+        if window == 0:
+            # if window = 0, calculate the entire interval in one go
+            window = end_time - start_time
+        assert (end_time - start_time) % window == 0
+        time = start_time
+        while time + window <= end_time:
+            time += window
+            yield time, window
+
+    def node_inputs(self, dependency_node):
+        inputs = {}
+        for dependency in dependency_node.dependencies:
+            inputs[dependency.source_id] = sorted(inputs.get(dependency.source_id, []) + self.data_input[dependency.source_id, dependency.start_time:dependency.end_time])
+        return inputs
+
+    def dependency_levels(self, time_dependency):
+        """Groups the unmet calculated nodes into levels, so that the nodes of a level only depend on earlier levels.
+
+        Unmet raw nodes are met on the way, as nothing can be done for them."""
+        order = {}
+        visited = set()
+        queue = [time_dependency]
+        while queue:
+            # Nodes are ordered as in a breadth-first walk
+            following = []
+            for node in queue:
+                if id(node) in visited:
+                    continue
+                visited.add(id(node))
+                if node.source_id != '@' and not node.met:
+                    if self.s_type(node.source_id) == 'raw':
+                        node.meet()
+                    else:
+                        order[node] = len(order)
+                following += node.dependencies
+            queue = following
+
+        remaining = {node: sum(1 for d in node.dependencies if d in order) for node in order}
+        levels = []
+        level = [node for node in order if remaining[node] == 0]
+        while level:
+            levels.append(level)
+            following = []
+            for node in level:
+                for dependee in node.dependees:
+                    if dependee in remaining:
+                        remaining[dependee] -= 1
+                        if remaining[dependee] == 0:
+                            following.append(dependee)
+            level = sorted(following, key=lambda node: order[node])
+        return levels
+
+    def calculate_levels(self, time_dependency, force_store):
+        """Calculates the unmet nodes level by level, running the calculations of a level in parallel.
+
+        Inputs are read and results stored in this thread, in the same order for every run."""
+        levels = ([(self, node) for node in level] for level in self.dependency_levels(time_dependency))
+        calculate_levels(levels, self.workers, self.processes, force_store)
+
+    @contextlib.contextmanager
+    def keep_hot(self, time_dependency):
+        """Keeps the data the unmet nodes of the time dependency still need from being spilled by the reader."""
+        self.data_input.set_hot_windows(lambda: self.hot_windows(time_dependency))
+        try:
+            yield
+        finally:
+            self.data_input.set_hot_windows(None)
+
     def calculate_unmet(self, time_dependency, force_store=set()):
         def resolve(dependency_node):
-            source_id, start_time, end_time = dependency_node.source_id, dependency_node.start_time, dependency_node.end_time
+            source_id = dependency_node.source_id
             if self.s_type(source_id) == 'raw':
                 # If a raw source is missing, nothing is to be done
                 dependency_node.meet()
                 return
-            feature = self.features[source_id]
-            window = human_time(feature['window'])
-            if window == 0:
-                # if window = 0, calculate the entire interval in one go
-                window = end_time - start_time
-            assert (end_time - start_time) % window == 0
-            time = start_time
-            while time + window <= end_time:
-                time += window
+            for time, window in self.windows(dependency_node):
                 self.print(f"Calculating {source_id} for time {time} (window {window})", 3)
 
-                inputs = {}
-
-                for dependency in dependency_node.dependencies:
-                    if not dependency.met:
-                        resolve(dependency)
-                    inputs[dependency.source_id] = sorted(inputs.get(dependency.source_id, []) + self.data_input[dependency.source_id, dependency.start_time:dependency.end_time])
+                inputs = self.node_inputs(dependency_node)
 
                 self.print(f"Calculating feature {source_id}.", 4)
-                # Load the function that calculates the value
-                f = get_callable(feature['function'])
-                # Calculate the missing data point
-                self.current_calculation = f"{source_id} @ {time} ({window})"
-                try:
-                    data_points = f(time, window, inputs)
-                except Exception as e:
-                    if 'default' in feature:
-                        data_points = [(time, window, feature['default'])]
-                        DataHandler.warning(f"Used default value!")
-                    else:
-                        raise DataHandler.FeatureCalculationError(source_id, time, window, inputs, e, desc=f"\n{traceback.format_exc()}")
-                finally:
-                    self.current_calculation = None
-
-                self.print(f"Feature {source_id} calculated for {time}.", 4)
-
-                # Make a JSON for storing into the database
-                #j_point = self.make_json(source_id, end_time, timestep, data_point)
-                #self.print(j_point, 5)
-                if feature.get('store', False) or source_id in force_store:
-                    # Some values may not need to be stored into the database
-                    self.print(f"Storing feature {source_id} into the database.", 4)  
-                    self.data_output.add_entries(source_id, data_points)
-
-                # All values are stored into the cache, so repeated lookups into
-                # the database are not necessary
-                self.print(f"Storing feature {source_id} into the cache.", 4)  
-                self.data_input.add_entries(source_id, data_points)
+                result = self.calculate_feature(source_id, time, window, inputs)
+                self.store_feature(source_id, time, window, inputs, result, force_store)
                 dependency_node.meet()
         
-        for node in time_dependency.walk():
-            if not node.met:
-                resolve(node)
+        # Data outside of the windows that are still needed may be spilled by the reader
+        with self.keep_hot(time_dependency):
+            if self.workers > 1:
+                self.calculate_levels(time_dependency, force_store)
+            else:
+                # Unmet dependencies are resolved before their dependees
+                for node in time_dependency.resolution_order(lambda node: node.met):
+                    resolve(node)
+
+
+def calculate_levels(levels, workers, processes=False, force_store=set(), fail=None):
+    """Calculates levels of (handler, node) pairs in a pool of `workers` threads, or processes with `processes`.
+
+    The nodes of a level must only depend on nodes of earlier levels. Inputs are read and results
+    stored in the calling thread, in the order of the levels. Errors are raised, or with `fail`, passed
+    to `fail(handler, exception)` and the remaining nodes of the handler are skipped."""
+    from joblib import Parallel, delayed
+
+    failed = set()
+
+    def attempt(handler, f, *args):
+        if handler in failed:
+            return
+        try:
+            f(*args)
+        except Exception as e:
+            if fail is None:
+                raise
+            failed.add(handler)
+            fail(handler, e)
+
+    # Only a few batches are prepared at a time, so the inputs of a whole level are never held at once
+    batch_size = 4 * workers
+    with Parallel(n_jobs=workers, prefer='processes' if processes else 'threads') as parallel:
+        for level in levels:
+            for i in range(0, len(level), batch_size):
+                calculations = []
+
+                def prepare(handler, node):
+                    for time, window in handler.windows(node):
+                        handler.print(f"Calculating {node.source_id} for time {time} (window {window})", 3)
+                        calculations.append((handler, node, time, window, handler.node_inputs(node)))
+
+                for handler, node in level[i:i + batch_size]:
+                    attempt(handler, prepare, handler, node)
+                calculations = [c for c in calculations if c[0] not in failed]
+                results = parallel(delayed(handler.calculate_feature)(node.source_id, time, window, inputs) for handler, node, time, window, inputs in calculations)
+                for (handler, node, time, window, inputs), result in zip(calculations, results):
+                    attempt(handler, handler.store_feature, node.source_id, time, window, inputs, result, force_store)
+                for handler, node in level[i:i + batch_size]:
+                    node.meet()
@@ -1,18 +1,74 @@
-import logging
+import logging, os, threading, time
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from bson.objectid import ObjectId
 from datetime import datetime
 
+# Fields needed to decode sensor data packages
+SENSOR_DATA_PROJECTION = {'_id': False, 'LocationId': True, 'SourceId': True, 'Data': True}
+
+# Seconds after which missing collections are looked for again
+COLLECTION_NAMES_TTL = 300
+
+_CLIENTS = {}
+_COLLECTION_NAMES = {}
+_LOCK = threading.Lock()
+
+def get_client(connection_url):
+    """Returns the client of the connection url, shared by all data stores of the process.
+
+    Clients are not fork-safe, so a forked process creates its own."""
+    key = (os.getpid(), connection_url)
+    with _LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = MongoClient(connection_url)
+        return _CLIENTS[key]
+
+def get_collection_names(connection_url, db, expected=None):
+    """Returns the collection names of the database, listed once and shared by the data stores of the process.
+
+    Collections may be created later, e.g., the archive of the previous month. If the `expected`
+    collection is missing, the names are listed again once the listing is older than COLLECTION_NAMES_TTL."""
+    key = (os.getpid(), connection_url, db.name)
+    with _LOCK:
+        names, listed = _COLLECTION_NAMES.get(key, (None, None))
+        if names is None or expected not in names and time.monotonic() - listed > COLLECTION_NAMES_TTL:
+            names, listed = set(db.list_collection_names()), time.monotonic()
+            _COLLECTION_NAMES[key] = (names, listed)
+        return names
+
+def close_clients():
+    """Closes all shared clients, e.g., before the process exits."""
+    with _LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+        _COLLECTION_NAMES.clear()
+
+def archive_collection_name(collection_name, now):
+    """Returns the name of the collection archiving the month before `now`."""
+    year, month = (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+    return f"{collection_name}-{year}-{month}"
+
+def _flatten(document, prefix=''):
+    """Returns the fields of nested documents as dotted paths."""
+    fields = {}
+    for key, value in document.items():
+        if isinstance(value, dict) and value:
+            fields.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            fields[f"{prefix}{key}"] = value
+    return fields
+
 class DataStore:
     def __init__(self, collection_name, connection_url):
-        self.client = MongoClient(connection_url)
+        self.client = get_client(connection_url)
         self.db = self.client.get_database()
         self.collection = self.db[collection_name]
         self.archive_collection = None
-        archive_collection_name = f"{collection_name}-{datetime.utcnow().year}-{datetime.utcnow().month - 1}"
-        if archive_collection_name in self.db.list_collection_names():
-            self.archive_collection = self.db[archive_collection_name]
+        archive_name = archive_collection_name(collection_name, datetime.utcnow())
+        if archive_name in get_collection_names(connection_url, self.db, archive_name):
+            self.archive_collection = self.db[archive_name]
 
 
     def insert_one(self, data):
@@ -23,6 +79,18 @@ class DataStore:
         result = self.collection.insert_many(data)
         return result.inserted_ids
 
+    def upsert_many(self, data, keys):
+        """Inserts the documents or updates the ones with the same values of the `keys` fields, in one unordered bulk write.
+
+        Keys may be dotted paths into the documents."""
+        operations = []
+        for document in data:
+            fields = _flatten(document)
+            key = {k: fields.pop(k) for k in keys}
+            operations.append(UpdateOne(key, {'$set': fields}, upsert=True))
+        result = self.collection.bulk_write(operations, ordered=False)
+        return result.upserted_count + result.modified_count
+
     def find_by_id(self, document_id):
         result = self.collection.find_one({ '_id': ObjectId(document_id) })
         return result
@@ -43,23 +111,101 @@ class SensorsDataStore(DataStore):
         result = self.collection.find_one({ 'LocationId': location_id })
         return result
 
-    def get_sensor_data(self, from_timestamp, to_timestamp, location_id, source_id = None, limit = 9000):
-        query = {
-            'LocationId': location_id,
-            'Data.Timestamp': {
-                '$gt': from_timestamp,
-                '$lte': to_timestamp
-            }
-        }
-
-        if source_id is not None:
-            query['SourceId'] = source_id
-        
-        logging.debug(f"Loading from {self.collection.name}")
-        result = list(self.collection.find(query, limit=limit))
-        logging.debug(f"Loaded {len(result)} from collection")
-        
+    def collections(self):
         if self.archive_collection is not None:
-            result.extend(list(self.archive_collection.find(query, limit=limit)))
-            logging.debug(f"Total {len(result)} results loaded")
-        return result
+            return [self.collection, self.archive_collection]
+        return [self.collection]
+
+    @staticmethod
+    def windows_query(windows, timestamp_field, scale=1, lookback=0):
+        """Returns a filter matching any of the (source_id, from_timestamp, to_timestamp) windows.
+
+        The timestamps of the windows are divided by `scale` before they are compared to the field.
+        With `lookback`, the windows start that much earlier, e.g., to match packages starting before them."""
+        clauses = []
+        for source_id, from_timestamp, to_timestamp in windows:
+            clause = {
+                timestamp_field: {
+                    '$gt': (from_timestamp - lookback) / scale,
+                    '$lte': to_timestamp / scale
+                }
+            }
+            if source_id is not None:
+                clause['SourceId'] = source_id
+            clauses.append(clause)
+        return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+    @staticmethod
+    def location_query(location_id):
+        """Returns a filter matching a single location id, or any of a list of location ids."""
+        return {'LocationId': {'$in': location_id} if isinstance(location_id, list) else location_id}
+
+    def iter_sensor_data(self, from_timestamp, to_timestamp, location_id, source_id = None, limit = None, batch_size = 1000, projection = SENSOR_DATA_PROJECTION):
+        """Streams the matching packages of the collection and then of the archive collection.
+
+        The cursors fetch `batch_size` packages per round trip, so packages can be processed while
+        iterating instead of after the whole result was loaded. `limit` applies to each collection."""
+        return self.iter_windows_data(location_id, [(source_id, from_timestamp, to_timestamp)], limit, batch_size, projection)
+
+    def iter_windows_data(self, location_id, windows, limit = None, batch_size = 1000, projection = SENSOR_DATA_PROJECTION, lookback = 0):
+        """Like iter_sensor_data, but streams the packages of many (source_id, from_timestamp, to_timestamp) windows with one query per collection.
+
+        `location_id` may be a list, to query the same windows of many locations at once. Packages
+        starting up to `lookback` before a window are streamed as well."""
+        query = self.location_query(location_id)
+        query.update(self.windows_query(windows, 'Data.Timestamp', lookback=lookback))
+
+        for collection in self.collections():
+            logging.debug(f"Loading from {collection.name}")
+            count = 0
+            with collection.find(query, projection=projection, limit=limit or 0, batch_size=batch_size) as cursor:
+                for package in cursor:
+                    count += 1
+                    yield package
+            logging.debug(f"Loaded {count} from {collection.name}")
+
+    def iter_sensor_samples(self, from_timestamp, to_timestamp, location_id, source_id = None, batch_size = 1000):
+        """Streams the single samples of the matching packages, unpacked by an aggregation on the server.
+
+        Every row has the LocationId, the SourceId, the sample Timestamp in seconds, its Timestep and its Value. Samples
+        after `to_timestamp` are dropped, so only samples in the interval (from_timestamp, to_timestamp] are returned."""
+        return self.iter_windows_samples(location_id, [(source_id, from_timestamp, to_timestamp)], batch_size)
+
+    def iter_windows_samples(self, location_id, windows, batch_size = 1000, lookback = 0):
+        """Like iter_sensor_samples, but streams the samples of many (source_id, from_timestamp, to_timestamp) windows with one aggregation per collection.
+
+        `location_id` may be a list, to query the same windows of many locations at once. The samples
+        of packages starting up to `lookback` before a window are included if they fall into the window."""
+        match = self.location_query(location_id)
+        match['Data.Measurements.0'] = {'$exists': True}
+        match.update(self.windows_query(windows, 'Data.Timestamp', lookback=lookback))
+
+        pipeline = [
+            {'$match': match},
+            {'$project': {
+                '_id': False,
+                'LocationId': True,
+                'SourceId': True,
+                'Timestamp': {'$divide': ['$Data.Timestamp', 1000]},
+                'Timestep': {'$divide': ['$Data.Timestep', {'$size': '$Data.Measurements'}]},
+                'Measurements': '$Data.Measurements'
+            }},
+            {'$unwind': {'path': '$Measurements', 'includeArrayIndex': 'Index'}},
+            {'$project': {
+                'LocationId': True,
+                'SourceId': True,
+                'Timestamp': {'$add': ['$Timestamp', {'$multiply': ['$Timestep', '$Index']}]},
+                'Timestep': True,
+                'Value': '$Measurements'
+            }},
+            # Samples are kept only inside the window of their source
+            {'$match': self.windows_query(windows, 'Timestamp', scale=1000)}
+        ]
+
+        for collection in self.collections():
+            logging.debug(f"Aggregating samples from {collection.name}")
+            with collection.aggregate(pipeline, batchSize=batch_size) as cursor:
+                yield from cursor
+
+    def get_sensor_data(self, from_timestamp, to_timestamp, location_id, source_id = None, limit = None):
+        return list(self.iter_sensor_data(from_timestamp, to_timestamp, location_id, source_id, limit=limit, projection=None))
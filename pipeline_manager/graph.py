@@ -0,0 +1,55 @@
+from collections import deque
+
+
+class GraphNode:
+    """A node of a dependency graph, with its dependencies and dependees kept in insertion order.
+
+    Membership is checked on sets, so adding edges takes constant time even for wide fan-in."""
+
+    def __init__(self):
+        self.dependencies = []
+        self.dependees = []
+        self._dependency_set = set()
+        self._dependee_set = set()
+
+    def add_dependency(self, node):
+        if node not in self._dependency_set:
+            self._dependency_set.add(node)
+            self.dependencies.append(node)
+        if self not in node._dependee_set:
+            node._dependee_set.add(self)
+            node.dependees.append(self)
+
+    def walk(self):
+        """Yields every node below this one once, in breadth-first order. The root '@' is skipped."""
+        visited = {self}
+        queue = deque([self])
+        while queue:
+            node = queue.popleft()
+            for dependency in node.dependencies:
+                if dependency not in visited:
+                    visited.add(dependency)
+                    queue.append(dependency)
+            if node.source_id != '@':
+                yield node
+
+    def resolution_order(self, done):
+        """Yields the nodes below this one for which `done` is False, every node after all of its dependencies.
+
+        Nodes are visited in the order of a depth-first search, without recursion."""
+        visited = set()
+        for start in self.walk():
+            if start in visited or done(start):
+                continue
+            visited.add(start)
+            stack = [(start, iter(start.dependencies))]
+            while stack:
+                node, dependencies = stack[-1]
+                for dependency in dependencies:
+                    if dependency not in visited and not done(dependency):
+                        visited.add(dependency)
+                        stack.append((dependency, iter(dependency.dependencies)))
+                        break
+                else:
+                    stack.pop()
+                    yield node
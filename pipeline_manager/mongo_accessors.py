@@ -1,47 +1,111 @@
 from .data_store import SensorsDataStore
 
-import sys, os
+import sys, os, itertools
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.join(os.path.dirname(__file__), 'PipelineManager'))
 from .readers import Reader
 from .writers import Writer
+from .utils import prefetch
 
 SENSORS_COLLECTION_NAME='SensorDataPackages'
 COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME='CoachingAdditionalDataSources'
 
+# Longest time span in seconds of a package written by MongoWriter. Packages are found by their first
+# timestamp, so readers of packed data look back as far as the writers pack, see MongoReader's `pack_span`.
+MAX_PACK_SPAN = 24 * 3600
+
 def is_coaching_other_source(source_id):
     return not source_id.startswith('sens_')
 
 class MongoReader(Reader):
-    def __init__(self, location_id, connection_url):
-        super().__init__(location_id)
+    def __init__(self, location_id, connection_url, batch_size=1000, aggregate=False, pack_span=0):
+        super().__init__()
+        self.location_id = location_id
+        self.connection_url = connection_url
+        # Number of packages fetched per round trip, packages are decoded while the next batch is fetched
+        self.batch_size = batch_size
+        # Unpacks the measurements on the server instead of downloading whole packages
+        self.aggregate = aggregate
+        # Largest span in seconds of the packages written by the MongoWriters of the additional data sources,
+        # e.g., MAX_PACK_SPAN, or 0 if they do not pack entries
+        self.pack_span = pack_span
+        # The data stores share the clients of the process, which stay open for the next reader
         self.sensors_data_datastore = SensorsDataStore(SENSORS_COLLECTION_NAME, connection_url)
         self.additional_data_datastore = SensorsDataStore(COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME, connection_url)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.sensors_data_datastore.client.close()
-        self.additional_data_datastore.client.close()
-
     def query(self, source_id, start_time, end_time):
-        # for mongo convert to milliseconds
-        from_timestamp = start_time * 1000
-        to_timestamp = end_time * 1000
+        self.query_many([(source_id, start_time, end_time)])
 
-        data = []
-        if is_coaching_other_source(source_id):
-            data = self.additional_data_datastore.get_sensor_data(from_timestamp, to_timestamp, self.location_id, source_id)
-        else:
-            data = self.sensors_data_datastore.get_sensor_data(from_timestamp, to_timestamp, self.location_id, source_id)
+    def query_many(self, requests):
+        """Queries all (source_id, start_time, end_time) requests with a single query per collection."""
+        self.query_windows({self.location_id: self}, requests)
+
+    @classmethod
+    def query_locations(cls, readers, requests):
+        """Queries the same requests for the locations of all readers with a single `LocationId $in` query per collection."""
+        groups = {}
+        for reader in readers:
+            # Only readers of the same database and settings can share a query
+            key = (reader.connection_url, reader.batch_size, reader.aggregate, reader.pack_span)
+            if key not in groups:
+                groups[key] = {}
+            groups[key][reader.location_id] = reader
+
+        failures = {}
+        for locations in groups.values():
+            try:
+                next(iter(locations.values())).query_windows(locations, requests)
+            except Exception as e:
+                # A shared query fails for all of its locations
+                failures.update({reader: e for reader in locations.values()})
+        return failures
+
+    def query_windows(self, locations, requests):
+        """Queries the requests for the readers of `locations`, a dict mapping location ids to readers, with the data stores of this reader."""
+        windows = {}
+        for source_id, start_time, end_time in requests:
+            datastore = self.additional_data_datastore if is_coaching_other_source(source_id) else self.sensors_data_datastore
+            if datastore not in windows:
+                windows[datastore] = []
+            # for mongo convert to milliseconds
+            windows[datastore].append((source_id, start_time * 1000, end_time * 1000))
+
+        for datastore, datastore_windows in windows.items():
+            if self.aggregate:
+                self.query_samples(datastore, datastore_windows, locations)
+            else:
+                self.query_packages(datastore, datastore_windows, locations)
+
+    def lookback(self, datastore):
+        """Returns how long before a window the packages of the datastore may start, in milliseconds."""
+        # Additional data sources are written by MongoWriter, whose packages span up to `pack_span`
+        return self.pack_span * 1000 if datastore is self.additional_data_datastore else 0
+
+    def query_packages(self, datastore, windows, locations):
+        location_id = list(locations) if len(locations) > 1 else next(iter(locations))
+        data = prefetch(datastore.iter_windows_data(location_id, windows, batch_size=self.batch_size, lookback=self.lookback(datastore)), self.batch_size)
 
         for data_point in data:
             timestamp, source_id = data_point['Data']['Timestamp'] / 1000, data_point['SourceId'] # Data points in DB are stored with millisecond resolution
             timestep = data_point['Data']['Timestep']
-            if source_id not in self._DATA:
-                self._DATA[source_id] = {}
             measurements = data_point['Data']['Measurements']
             measurement_timestep = timestep / len(measurements)
-            for i, measurement in enumerate(measurements):
-                m_timestamp = timestamp + measurement_timestep * i
-                self._DATA[source_id][m_timestamp] = (m_timestamp, measurement_timestep, measurement)
+            locations[data_point['LocationId']].add_entries(source_id, [(timestamp + measurement_timestep * i, measurement_timestep, measurement) for i, measurement in enumerate(measurements)])
+
+    def query_samples(self, datastore, windows, locations):
+        location_id = list(locations) if len(locations) > 1 else next(iter(locations))
+        rows = prefetch(datastore.iter_windows_samples(location_id, windows, batch_size=self.batch_size, lookback=self.lookback(datastore)), self.batch_size)
+        while True:
+            batch = {}
+            for row in itertools.islice(rows, self.batch_size):
+                key = (row['LocationId'], row['SourceId'])
+                if key not in batch:
+                    batch[key] = []
+                batch[key].append((row['Timestamp'], row['Timestep'], row['Value']))
+            if not batch:
+                break
+            for (location_id, source_id), entries in batch.items():
+                locations[location_id].add_entries(source_id, entries)
 
 class InvalidOtherSourceError(Exception):
     def __init__(self, other_source_id):
@@ -51,9 +115,22 @@ class InvalidOtherSourceError(Exception):
     pass
 
 class MongoWriter(Writer):
-    def __init__(self, location_id, connection_url):
+    # Fields identifying a document, repeated writes of the same data point update it instead of adding a duplicate
+    KEYS = ('LocationId', 'SourceId', 'Data.Timestamp')
+
+    def __init__(self, location_id, connection_url, batch_size=1000, background=False, pack_size=1):
         super().__init__(location_id)
         self.additional_data_datastore = SensorsDataStore(COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME, connection_url)
+        # Buffered data points are written once there are `batch_size` of them
+        self.batch_size = batch_size
+        # With background flushing, a batch is written while the next one is being calculated
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=str(self)) if background else None
+        self._FLUSHING = None
+        # Consecutive data points of a source with the same timestep are packed into documents of up to `pack_size` measurements,
+        # spanning at most MAX_PACK_SPAN seconds
+        self.pack_size = pack_size
+        # Number of buffered data points kept back by the last flush
+        self._KEPT = 0
 
     def make_dict(self, source_id, timestamp, timestep, value):
         o = {
@@ -67,14 +144,90 @@ class MongoWriter(Writer):
         }
         return o
 
-    def __exit__(self, exc_type, exc_val, ext_tb):
+    def make_package(self, source_id, entries):
+        """Makes a single document of consecutive entries, which readers split evenly over its timestep."""
+        timestamp, timestep, value = entries[0]
+        o = self.make_dict(source_id, timestamp, timestep * len(entries), value)
+        o['Data']['Measurements'] = [entry[2] for entry in entries]
+        return o
+
+    def pack_span(self, timestep):
+        """Returns the time span of a package of entries with the timestep, at most MAX_PACK_SPAN."""
+        if timestep <= 0:
+            return 0
+        return max(1, min(self.pack_size, int(MAX_PACK_SPAN // timestep))) * timestep
+
+    def packages(self, entries):
+        """Splits sorted entries into runs of entries that follow each other without gaps.
+
+        Packages are aligned to a grid of `pack_span` seconds, so the same entries are packed the same
+        way whatever batches they are flushed in."""
+        package = []
+        cell = None
+        for entry in entries:
+            span = self.pack_span(entry[1])
+            entry_cell = entry[0] // span if span else entry[0]
+            if package and (entry_cell != cell or entry[1] != package[-1][1] or entry[0] != package[-1][0] + package[-1][1]):
+                yield package
+                package = []
+            cell = entry_cell
+            package.append(entry)
+        if package:
+            yield package
+
+    def complete(self, package):
+        """Checks whether a package reaches the end of its grid cell, so no later entries can join it."""
+        timestamp, timestep, _ = package[-1]
+        span = self.pack_span(timestep)
+        return not span or (timestamp + timestep) // span != timestamp // span
+
+    def add_entries(self, source_id, entries):
+        if not is_coaching_other_source(source_id):
+            raise InvalidOtherSourceError(source_id)
+        super().add_entries(source_id, entries)
+        if sum(len(data) for data in self._DATA.values()) >= self.batch_size + self._KEPT:
+            self.flush(keep_partial=True)
+
+    def flush(self, keep_partial=False):
+        """Writes the buffered data points and clears the buffer.
+
+        With `keep_partial`, the last package of every source stays in the buffer unless it is complete,
+        so packages do not depend on when the buffer is flushed."""
         dicts = []
+        kept = {}
         for source_id in self._DATA:
-            if not is_coaching_other_source(source_id):
-                raise InvalidOtherSourceError(source_id)
+            if self.pack_size > 1:
+                packages = list(self.packages(sorted(self._DATA[source_id].values(), key=lambda entry: entry[0])))
+                if keep_partial and packages and not self.complete(packages[-1]):
+                    kept[source_id] = {entry[0]: entry for entry in packages.pop()}
+                for package in packages:
+                    dicts.append(self.make_package(source_id, package))
+                continue
 
             for timestamp, (timestamp, timespan, value) in self._DATA[source_id].items():
                 dicts.append(self.make_dict(source_id, timestamp, timespan, value))
+        self._DATA = kept
+        self._KEPT = sum(len(data) for data in kept.values())
+
+        if not dicts:
+            return
+        if self.executor:
+            # At most one batch is written at a time, errors of the previous batch are raised here
+            self.wait()
+            self._FLUSHING = self.executor.submit(self.additional_data_datastore.upsert_many, dicts, self.KEYS)
+        else:
+            self.additional_data_datastore.upsert_many(dicts, self.KEYS)
+
+    def wait(self):
+        if self._FLUSHING is not None:
+            flushing, self._FLUSHING = self._FLUSHING, None
+            flushing.result()
 
-        if dicts:
-            self.additional_data_datastore.insert_many(dicts)
+    def __exit__(self, exc_type, exc_val, ext_tb):
+        try:
+            self.flush()
+            self.wait()
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
@@ -1,20 +1,17 @@
 import datetime, sys, os, traceback, pytz
 
-from .utils import human_time, merge_intervals, f_timestamp
+from .utils import human_time, f_timestamp, IntervalSet
 
 from .data_handler import DataHandler
+from .graph import GraphNode
+from .plan import PipelinePlan
 
 class PipelineManager(DataHandler):
-   
-    force_calculate : list
-   
-    class FeatureNode:
-        __NODES = {}
 
+    class FeatureNode(GraphNode):
         def __init__(self, source_id):
+            super().__init__()
             self.source_id = source_id
-            self.dependencies = []
-            self.dependees = []
 
         def __str__(self):
             return f'<FN: {self.source_id}>'
@@ -22,42 +19,12 @@ class PipelineManager(DataHandler):
         def __repr__(self):
             return str(self)
 
-        def add_dependency(self, node):
-            if node not in self.dependencies:
-                self.dependencies.append(node)
-            if self not in node.dependees:
-                node.dependees.append(self)
-
-        @staticmethod
-        def create_node(source_id):
-            if source_id not in PipelineManager.FeatureNode.__NODES:
-                node = PipelineManager.FeatureNode(source_id)
-                PipelineManager.FeatureNode.__NODES[source_id] = node
-            else:
-                node = PipelineManager.FeatureNode.__NODES[source_id]
-            return node
-
-        @staticmethod
-        def reset():
-            PipelineManager.FeatureNode.__NODES = {}
-
-        def walk(self):
-            queue = [self]
-            while queue:
-                node = queue.pop(0) 
-                queue += node.dependencies
-                if node.source_id != '@':
-                    yield node
-
-    class DependencyNode:
-        __NODES = {}
-
+    class DependencyNode(GraphNode):
         def __init__(self, source_id, start_time, end_time):
+            super().__init__()
             self.source_id = source_id
             self.start_time = start_time
             self.end_time = end_time
-            self.dependencies = []
-            self.dependees = []
             self.met = False
 
         def __str__(self):
@@ -65,42 +32,38 @@ class PipelineManager(DataHandler):
 
         def __repr__(self):
             return str(self)
-
-        def add_dependency(self, node):
-            if node not in self.dependencies:
-                self.dependencies.append(node)
-            if self not in node.dependees:
-                node.dependees.append(self)
                 
         def meet(self):
             self.met = True
 
-        @staticmethod
-        def create_node(source_id, start_time, end_time):
-            if source_id not in PipelineManager.DependencyNode.__NODES:
-                PipelineManager.DependencyNode.__NODES[source_id] = {}
-            if (start_time, end_time) not in PipelineManager.DependencyNode.__NODES[source_id]:
-                node = PipelineManager.DependencyNode(source_id, start_time, end_time)
-                PipelineManager.DependencyNode.__NODES[source_id][(start_time, end_time)] = node
-            else:
-                node = PipelineManager.DependencyNode.__NODES[source_id][(start_time, end_time)]
-            return node
-        
-        @staticmethod
-        def reset():
-            PipelineManager.DependencyNode.__NODES = {}
-            
-        @staticmethod
-        def get_nodes(source_id):
-            return PipelineManager.DependencyNode.__NODES.get(source_id, {})
-        
-        def walk(self):
-            queue = [self]
-            while queue:
-                node = queue.pop(0) 
-                queue += node.dependencies
-                if node.source_id != '@':
-                    yield node
+    class RunContext:
+        """The state of a single pipeline run: its plan, options and dependency graphs.
+
+        Every run gets a new context, so managers running at the same time, in threads or
+        under asyncio, do not share any graph state."""
+
+        def __init__(self, plan, force_calculate=()):
+            self.plan = plan
+            self.force_calculate = frozenset(force_calculate)
+            self._FEATURE_NODES = {}
+            self._DEPENDENCY_NODES = {}
+
+        def create_feature_node(self, source_id):
+            if source_id not in self._FEATURE_NODES:
+                self._FEATURE_NODES[source_id] = PipelineManager.FeatureNode(source_id)
+            return self._FEATURE_NODES[source_id]
+
+        def feature_exists(self, source_id):
+            return source_id in self._FEATURE_NODES
+
+        def create_dependency_node(self, source_id, start_time, end_time):
+            nodes = self._DEPENDENCY_NODES.setdefault(source_id, {})
+            if (start_time, end_time) not in nodes:
+                nodes[(start_time, end_time)] = PipelineManager.DependencyNode(source_id, start_time, end_time)
+            return nodes[(start_time, end_time)]
+
+        def get_nodes(self, source_id):
+            return self._DEPENDENCY_NODES.get(source_id, {})
 
     class ModelNotFoundError(Exception):
         def __init__(self, missing):
@@ -109,15 +72,21 @@ class PipelineManager(DataHandler):
             return "Model not found: " + self.missing
         pass
 
-    def __init__(self, location_id, data_input, data_output, pipeline, features, profile={}, forced_time=None, verbosity=0, force_calculate=[]):
+    def __init__(self, location_id, data_input, data_output, pipeline, features, profile=None, forced_time=None, verbosity=0, force_calculate=[]):
         super().__init__(location_id, data_input, data_output, features, profile=profile, force_calculate=force_calculate, verbosity=verbosity)
 
         self.pipeline = pipeline
         self.pipeline_name = pipeline['name']
         
         self.forced_time = forced_time
-        
-        PipelineManager.force_calculate = force_calculate
+
+        self._CONTEXT = None
+
+    def __getstate__(self):
+        # The graphs stay in the run, worker processes look up the plan on their own
+        state = super().__getstate__()
+        state['_CONTEXT'] = None
+        return state
 
     def get_time(self):
         if self.forced_time is None:
@@ -226,6 +195,7 @@ class PipelineManager(DataHandler):
         self.print(f"---- RUNNING PIPELINE {self.pipeline_name} FOR LOCATION {self.location_id} ----", 1)
         start_time = datetime.datetime.utcnow()
         self.print(f"Starting at {start_time}", 2)
+        self.begin()
         try:
             runtime = self.calculate_runtime()
             self.print(f"Calculated runtime {f_timestamp(runtime)}.", 1)
@@ -269,14 +239,7 @@ class PipelineManager(DataHandler):
             self.print(f"UNKNOWN ERROR, EXECUTION DISRUPTED")
             self.print(e, 2)
             raise e
-        pipeline_outputs = {}
-        #for output in self.pipeline['outputs']:
-        for output_node in missing.dependencies:
-            output = output_node.source_id
-            end_time = output_node.end_time
-
-            pipeline_outputs[output] = pipeline_outputs.get(output, [])
-            pipeline_outputs[output] += self.data_input[output, end_time]
+        pipeline_outputs = self.outputs(missing)
 
         end_time = datetime.datetime.utcnow()
 
@@ -287,140 +250,88 @@ class PipelineManager(DataHandler):
         self.print(f"Execution done at {end_time} (execution time: {(end_time - start_time).total_seconds()})", 2)
         return pipeline_outputs
 
-    def generate_feature_dependency(self):
-        # Calculate feature dependency hierarchy
+    def begin(self, plan=None):
+        """Starts a new run, with a plan compiled before, e.g., by a batch of runs of the same pipeline."""
+        self._CONTEXT = None if plan is None else PipelineManager.RunContext(plan, self.force_calculate)
 
-        # Reset the dependency between pipeline executions
-        PipelineManager.FeatureNode.reset()
+    def outputs(self, time_dependency):
+        """Returns the values of the pipeline outputs for the time dependency graph of a run."""
+        pipeline_outputs = {}
+        #for output in self.pipeline['outputs']:
+        for output_node in time_dependency.dependencies:
+            output = output_node.source_id
+            end_time = output_node.end_time
 
-        root = PipelineManager.FeatureNode.create_node('@')
-        
-        def recurse_dependency(source_id):
-            node = PipelineManager.FeatureNode.create_node(source_id)
-            
-            f_type = self.s_type(source_id)
-
-            if f_type == 'raw':
-                pass
-            elif f_type == 'calculated':
-                definition = self.features[source_id]
-                for inpt in definition['inputs']:
-                    if isinstance(inpt, tuple):
-                        in_source_id = inpt[0]
-                    else:
-                        in_source_id = inpt
-                    in_node = recurse_dependency(in_source_id)
-                    node.add_dependency(in_node)
-            elif f_type == 'model':
-                pass
-                # ------------------ DEPRECATED ------------------
-                # model = self._MODELS[source_id]
-
-                # for inpt in model['inputs']:
-                #     if isinstance(inpt, tuple):
-                #         in_source_id = inpt[0]
-                #     else:
-                #         in_source_id = inpt
-                #     in_node = recurse_dependency(in_source_id)
-                #     node.add_dependency(in_node)
-            return node                    
+            pipeline_outputs[output] = pipeline_outputs.get(output, [])
+            pipeline_outputs[output] += self.data_input[output, end_time]
+        return pipeline_outputs
 
-        for output in self.pipeline['outputs']:
-            node = recurse_dependency(output)
-            root.add_dependency(node)
+    def context(self):
+        """Returns the context of the current run, creating it on first use.
 
-        if 'parameters' in self.pipeline:
-            for parameter in self.pipeline['parameters']:
-                node = recurse_dependency(parameter)
-                root.add_dependency(node)
+        The plan is looked up once per run, changes to the definitions apply from the next run on."""
+        if self._CONTEXT is None:
+            self._CONTEXT = PipelineManager.RunContext(PipelinePlan.get(self.pipeline, self.features), self.force_calculate)
+        return self._CONTEXT
 
-        # DEPTHS = {}
+    def plan(self):
+        """Returns the compiled plan of the pipeline, shared by all runs of the same definition."""
+        return self.context().plan
 
-        # nodes = root.dependencies[:]
-        # DEPTHS['@'] = 0
-        # while nodes:
-        #     node = nodes.pop(0)
-        #     DEPTHS[node.source_id] = max(DEPTHS[d.source_id] for d in node.dependees if d.source_id in DEPTHS) + 1
-        #     nodes += node.dependencies
+    def feature_window(self, source_id):
+        return self.plan().windows[source_id]
 
-        return root
+    def feature_function(self, source_id):
+        return self.plan().functions[source_id]
 
+    def generate_feature_dependency(self):
+        # Calculate feature dependency hierarchy
+        context = self.context()
+        return context.plan.feature_graph(context.create_feature_node)
 
     def generate_time_dependency(self, end):
+        context = self.context()
+        return context.plan.time_graph(context.create_dependency_node, end)
 
-        # Reset the dependency between pipeline executions
-        PipelineManager.DependencyNode.reset()
-
-        def recursive_dependency(source_id, start_time, end_time, dependee):
-            f_type = self.s_type(source_id)
-
-            if f_type == 'raw':
-                # Raw dependencies are added as complete intervals
-                node = PipelineManager.DependencyNode.create_node(source_id, start_time, end_time)
-                dependee.add_dependency(node)
-            elif f_type == 'calculated':
-                # Calculated features are broken into intervals based on their own windows
-                definition = self.features[source_id]
-                f_window = human_time(definition['window'])
-
-                if f_window == 0:
-                    f_window = end_time - start_time
-
-                time = start_time
-
-                while time + f_window <= end_time: # Assume perfect divisibility of intervals
-                    node = PipelineManager.DependencyNode.create_node(source_id, time, time + f_window)
-                    dependee.add_dependency(node)
-                    for inpt in definition['inputs']:
-                        if isinstance(inpt, tuple):
-                            in_source_id = inpt[0]
-                            in_window = human_time(inpt[1])
-                        else:
-                            in_source_id = inpt
-                            in_window = f_window
-                        recursive_dependency(in_source_id, time + f_window - in_window, time + f_window, node)
-                    time += f_window
-        start = end - self.pipeline_window()
-
-        root = PipelineManager.DependencyNode.create_node('@', start, end) # @ represents the entire pipeline
 
-        for output in self.pipeline['outputs']:
-            recursive_dependency(output, start, end, root)
+    def smart_request_dependencies(self, runtime):
+        time_dependency = self.generate_time_dependency(runtime)
 
-        if 'parameters' in self.pipeline:
-            for parameter in self.pipeline['parameters']:
-                recursive_dependency(parameter, start, end, root)
-        
-        return root
+        # Sources of the same level do not depend on each other, so their requests are submitted together
+        for requests in self.level_requests():
+            if requests:
+                self.query_db_many(requests)
 
+        return time_dependency
 
-    def smart_request_dependencies(self, runtime):
-        feature_dependency = self.generate_feature_dependency()
+    def level_requests(self):
+        """Yields the (source_id, start_time, end_time) requests of the time dependency graph of the run, a level of features at a time.
 
-        time_dependency = self.generate_time_dependency(runtime)
+        Once resumed, the nodes of the level with data in the reader are met, so the requests must be fetched before."""
+        context = self.context()
+        force_calculate = context.force_calculate
+        for level in context.plan.feature_levels:
+            unmet = {}
+            requests = []
+            for source_id in level:
+                f_type = self.s_type(source_id)
+
+                # Calculate all unmet nodes for this source_id
+                unmet_nodes = [n for n in context.get_nodes(source_id).values() \
+                                if source_id in force_calculate or (not n.met) and any(not d.met for d in n.dependees)]
+                unmet_intervals = [(n.start_time, n.end_time) for n in unmet_nodes]
+                unmet[source_id] = unmet_nodes
+
+                unmet_merged = IntervalSet(unmet_intervals)
+                if not f_type == "calculated" or self.features[source_id].get('store', False):
+                    for start, end in unmet_merged:
+                        self.print(f"Querying {source_id}: {datetime.datetime.fromtimestamp(start)} -- {datetime.datetime.fromtimestamp(end)}", 5)
+                        requests.append((source_id, start, end))
+
+            yield requests
 
-        for dependency in feature_dependency.walk():
-            if dependency.source_id == '@':
-                continue
-            source_id = dependency.source_id
-            f_type = self.s_type(source_id)
-
-            # Calculate all unmet nodes for this source_id
-            unmet_nodes = [n for n in PipelineManager.DependencyNode.get_nodes(source_id).values() \
-                            if source_id in self.force_calculate or (not n.met) and any(not d.met for d in n.dependees)]
-            unmet_intervals = [(n.start_time, n.end_time) for n in unmet_nodes]
-
-            unmet_merged = merge_intervals(unmet_intervals)
-            if not f_type == "calculated" or self.features[source_id].get('store', False):
-                for start, end in unmet_merged:
-                    self.print(f"Querying {source_id}: {datetime.datetime.fromtimestamp(start)} -- {datetime.datetime.fromtimestamp(end)}", 5)
-                    self.query_db(source_id, start, end)
-            
             # Check if data was found for any unmet nodes
-            for unmet_node in unmet_nodes:
-                if self.data_input[source_id, unmet_node.start_time:unmet_node.end_time] and source_id not in self.force_calculate:
-                    unmet_node.meet()
-                
-                            
-               
-        return time_dependency
+            for source_id, unmet_nodes in unmet.items():
+                for unmet_node in unmet_nodes:
+                    if self.data_input[source_id, unmet_node.start_time:unmet_node.end_time] and source_id not in force_calculate:
+                        unmet_node.meet()
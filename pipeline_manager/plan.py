@@ -0,0 +1,188 @@
+import threading
+from collections import OrderedDict
+
+from .utils import human_time, get_callable
+
+# Pipelines with functions created on the fly get a new plan on every run, so only the most recently used plans are kept
+MAX_PLANS = 128
+_PLANS = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def _inputs(definition):
+    """Returns the source ids and parsed windows of the inputs of a feature.
+
+    Inputs without a window of their own get None, they use the window of the feature."""
+    inputs = []
+    for inpt in definition['inputs']:
+        if isinstance(inpt, tuple):
+            inputs.append((inpt[0], human_time(inpt[1])))
+        else:
+            inputs.append((inpt, None))
+    return tuple(inputs)
+
+
+class PipelinePlan:
+    """The feature and time dependency graphs of a pipeline, compiled once per pipeline definition.
+
+    The graphs have the same shape on every run, only their times move with the runtime. The plan
+    keeps the time dependency nodes as offsets from the runtime together with the indices of their
+    dependencies, so a run instantiates the nodes without parsing windows or walking definitions."""
+
+    def __init__(self, pipeline, features):
+        recurrence = pipeline['recurrence']
+        self.window = human_time(recurrence if isinstance(recurrence, str) else recurrence['period'])
+        self.outputs = tuple(pipeline['outputs']) + tuple(pipeline.get('parameters', []))
+
+        # Parsed windows, inputs and functions of the calculated features the pipeline needs
+        self.windows = {}
+        self.inputs = {}
+        self.functions = {}
+        stack = list(self.outputs)
+        while stack:
+            source_id = stack.pop()
+            if source_id in self.windows or source_id not in features:
+                continue
+            definition = features[source_id]
+            self.windows[source_id] = human_time(definition['window'])
+            self.inputs[source_id] = _inputs(definition)
+            self.functions[source_id] = get_callable(definition['function'])
+            stack += [in_source_id for in_source_id, _ in self.inputs[source_id]]
+
+        self.feature_nodes, self.feature_dependencies = self.compile_features()
+        self.feature_levels = self.compile_levels()
+        self.nodes, self.dependencies = self.compile_times()
+
+    def compile_features(self):
+        nodes = ['@']
+        index = {'@': 0}
+        dependencies = [[]]
+        linked = set()
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            source_id = nodes[i]
+            in_source_ids = self.outputs if source_id == '@' else [in_source_id for in_source_id, _ in self.inputs.get(source_id, ())]
+            for in_source_id in in_source_ids:
+                if in_source_id not in index:
+                    index[in_source_id] = len(nodes)
+                    nodes.append(in_source_id)
+                    dependencies.append([])
+                    stack.append(index[in_source_id])
+                if (i, index[in_source_id]) not in linked:
+                    linked.add((i, index[in_source_id]))
+                    dependencies[i].append(index[in_source_id])
+        return tuple(nodes), tuple(tuple(d) for d in dependencies)
+
+    def compile_levels(self):
+        """Groups the features into levels, where every feature comes after all of its dependees."""
+        remaining = [0] * len(self.feature_nodes)
+        for dependencies in self.feature_dependencies:
+            for j in dependencies:
+                remaining[j] += 1
+        levels = []
+        level = [0]
+        while level:
+            following = []
+            for i in level:
+                for j in self.feature_dependencies[i]:
+                    remaining[j] -= 1
+                    if remaining[j] == 0:
+                        following.append(j)
+            if following:
+                levels.append(tuple(self.feature_nodes[j] for j in following))
+            level = following
+        return tuple(levels)
+
+    def compile_times(self):
+        """Expands the time dependencies of a run ending at 0, so the times of the nodes are offsets from the runtime."""
+        nodes = [('@', -self.window, 0)]
+        index = {}
+        dependencies = [[]]
+        linked = set()
+
+        def dependency(source_id, start_time, end_time, dependee):
+            new = []
+            if source_id in self.windows:
+                # Calculated features are broken into intervals based on their own windows
+                f_window = self.windows[source_id] or end_time - start_time
+                intervals = []
+                time = start_time
+                while time + f_window <= end_time: # Assume perfect divisibility of intervals
+                    intervals.append((time, time + f_window))
+                    time += f_window
+            else:
+                # Raw dependencies are added as complete intervals
+                intervals = [(start_time, end_time)]
+            for interval in intervals:
+                key = (source_id,) + interval
+                if key not in index:
+                    index[key] = len(nodes)
+                    nodes.append(key)
+                    dependencies.append([])
+                    if source_id in self.windows:
+                        new.append(index[key])
+                if (dependee, index[key]) not in linked:
+                    linked.add((dependee, index[key]))
+                    dependencies[dependee].append(index[key])
+            return new
+
+        stack = []
+        for output in self.outputs:
+            stack += dependency(output, -self.window, 0, 0)
+        while stack:
+            i = stack.pop()
+            source_id, start_time, end_time = nodes[i]
+            for in_source_id, in_window in self.inputs[source_id]:
+                if in_window is None:
+                    in_window = end_time - start_time
+                stack += dependency(in_source_id, end_time - in_window, end_time, i)
+
+        return tuple(nodes), tuple(tuple(d) for d in dependencies)
+
+    def feature_graph(self, create_node):
+        """Creates the feature dependency nodes with `create_node(source_id)` and returns the root."""
+        nodes = [create_node(source_id) for source_id in self.feature_nodes]
+        for node, dependencies in zip(nodes, self.feature_dependencies):
+            for j in dependencies:
+                node.add_dependency(nodes[j])
+        return nodes[0]
+
+    def time_graph(self, create_node, end):
+        """Creates the time dependency nodes of a run ending at `end` with `create_node(source_id, start_time, end_time)` and returns the root."""
+        nodes = [create_node(source_id, end + start_offset, end + end_offset) for source_id, start_offset, end_offset in self.nodes]
+        for node, dependencies in zip(nodes, self.dependencies):
+            for j in dependencies:
+                node.add_dependency(nodes[j])
+        return nodes[0]
+
+    @staticmethod
+    def key(pipeline, features):
+        """Returns a hashable description of everything the plan depends on."""
+        definitions = []
+        visited = set()
+        stack = list(pipeline['outputs']) + list(pipeline.get('parameters', []))
+        while stack:
+            source_id = stack.pop()
+            if source_id in visited:
+                continue
+            visited.add(source_id)
+            definition = features.get(source_id)
+            if definition is not None:
+                inputs = tuple(definition['inputs'])
+                definitions.append((source_id, definition['window'], inputs, definition['function']))
+                stack += [inpt[0] if isinstance(inpt, tuple) else inpt for inpt in inputs]
+        return (repr(pipeline['recurrence']), tuple(pipeline['outputs']), tuple(pipeline.get('parameters', [])), tuple(definitions))
+
+    @staticmethod
+    def get(pipeline, features):
+        """Returns the cached plan of the pipeline, compiling it on first use."""
+        key = PipelinePlan.key(pipeline, features)
+        with _LOCK:
+            if key in _PLANS:
+                _PLANS.move_to_end(key)
+            else:
+                _PLANS[key] = PipelinePlan(pipeline, features)
+                while len(_PLANS) > MAX_PLANS:
+                    _PLANS.popitem(last=False)
+            return _PLANS[key]
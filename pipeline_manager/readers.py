@@ -1,11 +1,31 @@
-import csv, json, http.client, os.path
+import ast, csv, gzip, io, itertools, json, http.client, os, os.path, pickle, re, tempfile, threading
 from urllib.parse import urlencode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from .utils import f_timestamp
+from .utils import f_timestamp, human_time, IntervalSet
+from .time_series import TimeSeries, ColumnarTimeSeries
+from .cache import CacheFile
 
 class Reader():
+    columnar = False
+    _LOGGER = None
+
+    # Once the budget is exceeded, cold partitions are spilled until this fraction of the budget is used
+    LOW_WATER = 0.75
+
     def __init__(self):
         self._DATA = {}
+        self._COVERAGE = {}
+
+        self._BUDGET = None
+        self._NEXT_CHECK = None
+        self._PARTITION = None
+        self._HOT_WINDOWS = None
+        self._SPILL = None
+        self._SPILL_DIRECTORY = None
+        self._SPILLED = {}
+        self._ACCESSED = {}
+        self._TICK = 0
 
     def __str__(self):
         return self.__class__.__name__
@@ -14,7 +34,105 @@ class Reader():
         self._LOGGER = logger
 
     def log(self, msg, level):
-        self._LOGGER.print(f"[{self}] {msg}", level)
+        # Readers used without a DataHandler, e.g., wrapped by other readers, have no logger
+        if self._LOGGER is not None:
+            self._LOGGER.print(f"[{self}] {msg}", level)
+
+    def set_columnar(self, columnar=True):
+        """Stores numeric sources in NumPy arrays instead of per-sample tuples."""
+        self.columnar = columnar
+        for source_id, series in self._DATA.items():
+            entries = list(series.values())
+            if columnar and not isinstance(series, ColumnarTimeSeries) and ColumnarTimeSeries.accepts(entries):
+                self._DATA[source_id] = ColumnarTimeSeries(entries)
+            elif not columnar and isinstance(series, ColumnarTimeSeries):
+                self._DATA[source_id] = TimeSeries(entries)
+
+    def set_memory_budget(self, budget, spill_directory=None, partition='1d'):
+        """Spills cold partitions of the loaded data to disk once they take more than `budget` bytes."""
+        self._BUDGET = budget
+        self._NEXT_CHECK = budget
+        self._PARTITION = human_time(partition)
+        self._SPILL_DIRECTORY = spill_directory
+        self._check_budget()
+
+    def set_hot_windows(self, windows):
+        """Sets the intervals that are still needed, as a dict of IntervalSets per source or a callable returning it.
+
+        Partitions overlapping these intervals are never spilled. Without hot windows, least recently
+        used sources are spilled first."""
+        self._HOT_WINDOWS = windows
+
+    def memory_usage(self):
+        return sum(series.nbytes() for series in self._DATA.values())
+
+    def _check_budget(self):
+        if self._BUDGET is None:
+            return
+        usage = self.memory_usage()
+        if usage <= self._NEXT_CHECK:
+            return
+
+        hot = self._HOT_WINDOWS() if callable(self._HOT_WINDOWS) else self._HOT_WINDOWS
+        size = self._PARTITION
+        candidates = []
+        for source_id, series in self._DATA.items():
+            windows = hot.get(source_id) if hot is not None else None
+            for partition, _ in series.partitions(size):
+                if windows is None or not windows.overlaps(partition * size, (partition + 1) * size):
+                    candidates.append((self._ACCESSED.get(source_id, 0), partition, source_id))
+        candidates.sort()
+
+        for _, partition, source_id in candidates:
+            if usage <= self._BUDGET * self.LOW_WATER:
+                break
+            series = self._DATA[source_id]
+            before = series.nbytes()
+            self._spill(source_id, partition)
+            usage -= before - series.nbytes()
+
+        # If the hot data alone exceeds the budget, do not rescan on every added entry
+        self._NEXT_CHECK = max(self._BUDGET, usage * 1.25)
+        self.log(f"Memory usage after spilling {usage} bytes (budget {self._BUDGET} bytes)", 5)
+
+    def _spill(self, source_id, partition):
+        if self._SPILL is None:
+            self._SPILL = tempfile.TemporaryDirectory(prefix='pipeline_manager_', dir=self._SPILL_DIRECTORY)
+        start = partition * self._PARTITION
+        entries = self._DATA[source_id].pop_range(start, start + self._PARTITION)
+
+        fd, filename = tempfile.mkstemp(suffix='.pickle', dir=self._SPILL.name)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if source_id not in self._SPILLED:
+            self._SPILLED[source_id] = {}
+        self._SPILLED[source_id][partition] = filename
+
+    def _restore(self, source_id, start_time=None, end_time=None):
+        """Reloads the spilled partitions of a source that overlap [start_time, end_time]."""
+        self._TICK += 1
+        self._ACCESSED[source_id] = self._TICK
+        spilled = self._SPILLED.get(source_id)
+        if not spilled:
+            return
+        first = None if start_time is None else start_time // self._PARTITION
+        last = None if end_time is None else end_time // self._PARTITION
+        for partition in [p for p in spilled if (first is None or p >= first) and (last is None or p <= last)]:
+            filename = spilled.pop(partition)
+            with open(filename, 'rb') as f:
+                self._DATA[source_id].add(pickle.load(f))
+            os.remove(filename)
+
+    def sources(self):
+        return list(self._DATA)
+
+    def entries(self, source_id):
+        """Yields all entries of a source, including spilled ones, without loading them back into memory."""
+        if source_id in self._DATA:
+            yield from self._DATA[source_id].values()
+        for filename in self._SPILLED.get(source_id, {}).values():
+            with open(filename, 'rb') as f:
+                yield from pickle.load(f)
 
     def load(self):
         pass
@@ -23,10 +141,10 @@ class Reader():
         source_id, target_time = item
         if source_id in self._DATA:
             if isinstance(target_time, slice):
-                start = target_time.start
-                end = target_time.stop
-                return sorted([val for time, val in self._DATA[source_id].items() if start < time <= end])
+                self._restore(source_id, target_time.start, target_time.stop)
+                return self._DATA[source_id].range(target_time.start, target_time.stop)
             else:
+                self._restore(source_id, target_time, target_time)
                 return [ self._DATA[source_id][target_time] ]
         else:
             return []
@@ -36,277 +154,850 @@ class Reader():
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        if self._SPILL is not None:
+            self._SPILL.cleanup()
+            self._SPILL = None
+            self._SPILLED = {}
 
     def __contains__(self, item):
         source_id, timestamp = item
+        if source_id in self._SPILLED:
+            self._restore(source_id, timestamp, timestamp)
         return source_id in self._DATA and timestamp in self._DATA[source_id]
 
     def query(self, source_id, start_time, end_time):
         raise NotImplementedError("The reader is missing the query method.")
 
+    def query_many(self, requests):
+        """Queries a batch of (source_id, start_time, end_time) requests.
+
+        Readers that can serve several requests in one round trip override this."""
+        for source_id, start_time, end_time in requests:
+            self.query(source_id, start_time, end_time)
+
+    def fetch(self, source_id, start_time, end_time):
+        """Queries only the parts of the interval that were not fetched before."""
+        self.fetch_many([(source_id, start_time, end_time)])
+
+    def fetch_many(self, requests):
+        """Queries only the parts of the (source_id, start_time, end_time) requests that were not fetched before, as one batch."""
+        gaps = self.gaps(requests)
+        if gaps:
+            self.query_many(gaps)
+            self.cover(gaps)
+
+    def gaps(self, requests):
+        """Returns the parts of the (source_id, start_time, end_time) requests that were not fetched before."""
+        requested = {}
+        for source_id, start_time, end_time in requests:
+            if source_id not in requested:
+                requested[source_id] = IntervalSet()
+            requested[source_id].add(start_time, end_time)
+
+        gaps = []
+        for source_id, intervals in requested.items():
+            if source_id not in self._COVERAGE:
+                self._COVERAGE[source_id] = IntervalSet()
+            for start_time, end_time in intervals:
+                gaps += [(source_id, start, end) for start, end in self._COVERAGE[source_id].gaps(start_time, end_time)]
+        return gaps
+
+    def cover(self, requests):
+        """Marks the (source_id, start_time, end_time) requests as fetched."""
+        for source_id, start, end in requests:
+            if source_id not in self._COVERAGE:
+                self._COVERAGE[source_id] = IntervalSet()
+            self._COVERAGE[source_id].add(start, end)
+
+    @classmethod
+    def fetch_locations(cls, requests):
+        """Like fetch_many, but for the readers of several locations, given as a dict mapping readers to their requests.
+
+        Readers missing the same intervals are queried together with query_locations. Returns the
+        exceptions of the readers whose queries failed, the requests of the other readers are covered."""
+        groups = {}
+        for reader, reader_requests in requests.items():
+            gaps = tuple(reader.gaps(reader_requests))
+            if gaps:
+                if gaps not in groups:
+                    groups[gaps] = []
+                groups[gaps].append(reader)
+
+        failures = {}
+        for gaps, readers in groups.items():
+            try:
+                failed = cls.query_locations(readers, list(gaps))
+            except Exception as e:
+                failed = {reader: e for reader in readers}
+            for reader in readers:
+                if reader not in failed:
+                    reader.cover(gaps)
+            failures.update(failed)
+        return failures
+
+    @classmethod
+    def query_locations(cls, readers, requests):
+        """Queries the same batch of requests for the readers of several locations, returning the exceptions of the readers that failed.
+
+        Readers that can query many locations in one round trip override this."""
+        failures = {}
+        for reader in readers:
+            try:
+                reader.query_many(requests)
+            except Exception as e:
+                failures[reader] = e
+        return failures
+
     def is_online(self):
         return True
 
     def add_entries(self, source_id, entries):
-        if source_id not in self._DATA:
-            self._DATA[source_id] = {}
-        for entry in entries:
-            timestamp = entry[0]
-            self._DATA[source_id][timestamp] = entry
-
-class CSVReader(Reader):
+        if self._SPILLED.get(source_id):
+            # Reload overlapping partitions first, so they cannot overwrite the new entries later
+            entries = list(entries)
+            if entries:
+                self._restore(source_id, min(e[0] for e in entries), max(e[0] for e in entries))
+        if self.columnar:
+            entries = list(entries)
+            series = self._DATA.get(source_id)
+            if series is None:
+                # Numeric sources are stored in columns, others fall back to tuples
+                series_class = ColumnarTimeSeries if ColumnarTimeSeries.accepts(entries) else TimeSeries
+                series = self._DATA[source_id] = series_class()
+            elif isinstance(series, ColumnarTimeSeries) and not series.matches(entries):
+                series = self._DATA[source_id] = TimeSeries(series.values())
+            series.add(entries)
+        else:
+            if source_id not in self._DATA:
+                self._DATA[source_id] = TimeSeries()
+            self._DATA[source_id].add(entries)
+        self._check_budget()
 
-    def __init__(self, location_id, targets):
-        super().__init__(location_id)
-        self.targets = targets
+    def columns(self, source_id, start_time, end_time):
+        """Returns the timestamps, timesteps and values of a source in the interval (start_time, end_time].
 
-        import sys
-        csv.field_size_limit(sys.maxsize)
+        Columnar sources return array views, other sources return lists."""
+        if source_id in self._DATA:
+            self._restore(source_id, start_time, end_time)
+            return self._DATA[source_id].columns(start_time, end_time)
+        else:
+            return [], [], []
 
-    def is_online(self):
-        return False
+class OfflineReader(Reader):
+    """Base of the readers that load data from files instead of querying a database.
 
-    def load(self):
-        for filename, timestep in self.targets:
-            
-            with open(filename) as f:
-                reader = csv.reader(f)
-                header = next(reader)
-                for source_id in header[1:]:
-                    if source_id not in self._DATA:
-                        self._DATA[source_id] = {}
-                for row in reader:
-                    timestamp, *data = row
-                    timestamp = int(timestamp) / 1000
-                    for i, value in enumerate(data):
-                        source_id = header[i+1]
-                        try:
-                            true_val = eval(value)
-                        except Exception:
-                            true_val = value
-                        finally:
-                            self._DATA[source_id][timestamp] = (timestamp, timestep, true_val)
+    A lazy reader only builds an index on load(), recording where the records of every source
+    and time bucket are stored. The records are parsed when a query or a lookup first needs them."""
 
-    def query(self, source_id, start_time, end_time):
-        pass
+    # Size of the time buckets in the index
+    BUCKET = 86400
 
-class JSONReader__SAAM(Reader):
-    def __init__(self, location_id, targets):
+    def __init__(self, location_id, targets, lazy=False, workers=1):
         super().__init__()
         self.location_id = location_id
         self.targets = targets
+        self.lazy = lazy
+        # With more than one worker, the targets are loaded in a process pool
+        self.workers = workers
+        self._INDEX = {}
+        self._EXTENT = {}
+        self._LOADED = {}
 
     def is_online(self):
-        return False
+        # Lazy readers load their data when it is queried
+        return self.lazy
 
     def load(self):
-        for filename in self.targets:
-            
-            with open(filename) as f:
-                _ = f.read().replace('\x13', '')
-                data = json.loads(_)
-            for data_point in data:
-                if self.location_id == data_point['LocationId']:
-                    timestamp, source_id = data_point['Data']['Timestamp'] / 1000, data_point['SourceId'] # Data points in DB are stored with millisecond resolution
-                    timestep = data_point['Data']['Timestep']
-                    if source_id not in self._DATA:
-                        self._DATA[source_id] = {}
-                    measurements = data_point['Data']['Measurements']
-                    measurement_timestep = timestep / len(measurements)
-                    for i, measurement in enumerate(measurements):
-                        m_timestamp = timestamp + measurement_timestep * i
-                        self._DATA[source_id][m_timestamp] = (m_timestamp, measurement_timestep, measurement)
+        if self.workers > 1 and len(self.targets) > 1:
+            options = dict(self.options(), lazy=self.lazy)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # Results are merged in the order of the targets, as if they were loaded one by one
+                for state in executor.map(_load_target, itertools.repeat(type(self)), itertools.repeat(self.location_id), self.targets, itertools.repeat(options)):
+                    self.merge(state)
+        else:
+            for target in self.targets:
+                self.load_target(target)
 
-    def query(self, source_id, start_time, end_time):
-        pass
+    def load_target(self, target):
+        raise NotImplementedError("The reader is missing the load_target method.")
 
-class JSONReader(Reader):
-    def __init__(self, location_id, targets):
-        super().__init__()
-        self.location_id = location_id
-        self.targets = targets
+    def options(self):
+        """Returns the constructor arguments a worker needs to load a target like this reader."""
+        return {}
 
-    def is_online(self):
-        return False
+    def state(self):
+        """Returns the loaded data and index, to be sent from a worker process."""
+        return {
+            'data': {source_id: list(series.values()) for source_id, series in self._DATA.items()},
+            'index': self._INDEX,
+            'extent': self._EXTENT
+        }
 
-    def load(self):
-        for filename in self.targets:
-            
-            with open(filename) as f:
-                _ = f.read().replace('\x13', '')
-                data = json.loads(_)
-            for data_point in data:
-                if self.location_id == data_point['location_id'] or data_point['location_id'] == '':
-                    timestamp, source_id = data_point['timestamp'], data_point['source_id']
-                    timestep = data_point['timestep']
-                    if source_id not in self._DATA:
-                        self._DATA[source_id] = {}
-                    measurements = data_point['values']
-                    measurement_timestep = timestep / len(measurements)
-                    for i, measurement in enumerate(measurements):
-                        m_timestamp = timestamp + measurement_timestep * i
-                        self._DATA[source_id][m_timestamp] = (m_timestamp, measurement_timestep, measurement)
+    def merge(self, state):
+        for source_id, entries in state['data'].items():
+            self.add_entries(source_id, entries)
+        for source_id, buckets in state['index'].items():
+            if source_id not in self._INDEX:
+                self._INDEX[source_id] = {}
+                self._EXTENT[source_id] = 0
+            for bucket, locations in buckets.items():
+                if bucket not in self._INDEX[source_id]:
+                    self._INDEX[source_id][bucket] = []
+                self._INDEX[source_id][bucket] += locations
+            self._EXTENT[source_id] = max(self._EXTENT[source_id], state['extent'][source_id])
+
+    def index(self, source_id, timestamp, timestep, location):
+        """Records that a record of the source starting at `timestamp` can be loaded from `location`."""
+        if source_id not in self._INDEX:
+            self._INDEX[source_id] = {}
+            self._EXTENT[source_id] = 0
+        bucket = timestamp // self.BUCKET
+        if bucket not in self._INDEX[source_id]:
+            self._INDEX[source_id][bucket] = []
+        self._INDEX[source_id][bucket].append(location)
+        # A record also covers the time after its timestamp
+        self._EXTENT[source_id] = max(self._EXTENT[source_id], timestep)
+
+    def load_locations(self, source_id, locations):
+        raise NotImplementedError("The reader is missing the load_locations method.")
+
+    def _ensure(self, source_id, start_time=None, end_time=None):
+        """Loads the indexed records of a source that may hold data in (start_time, end_time]."""
+        if not self.lazy or source_id not in self._INDEX:
+            return
+        buckets = self._INDEX[source_id]
+        if source_id not in self._LOADED:
+            self._LOADED[source_id] = set()
+        loaded = self._LOADED[source_id]
+        first = None if start_time is None else (start_time - self._EXTENT[source_id]) // self.BUCKET
+        last = None if end_time is None else end_time // self.BUCKET
+        pending = sorted(b for b in buckets if b not in loaded and (first is None or b >= first) and (last is None or b <= last))
+        if pending:
+            self.log(f"Loading {source_id} from {len(pending)} buckets", 5)
+            self.load_locations(source_id, [location for b in pending for location in buckets[b]])
+            loaded.update(pending)
 
     def query(self, source_id, start_time, end_time):
-        pass
+        self._ensure(source_id, start_time, end_time)
+
+    def __getitem__(self, item):
+        source_id, target_time = item
+        if isinstance(target_time, slice):
+            self._ensure(source_id, target_time.start, target_time.stop)
+        else:
+            self._ensure(source_id, target_time, target_time)
+        return super().__getitem__(item)
+
+    def __contains__(self, item):
+        source_id, timestamp = item
+        self._ensure(source_id, timestamp, timestamp)
+        return super().__contains__(item)
+
+    def sources(self):
+        return list(set(self._DATA) | set(self._INDEX))
+
+    def entries(self, source_id):
+        self._ensure(source_id)
+        return super().entries(source_id)
+
+def _load_target(reader_class, location_id, target, options):
+    """Loads a single target of an offline reader in a worker process."""
+    reader = reader_class(location_id, [target], **options)
+    reader.load()
+    return reader.state()
+
+def parse_literal(value):
+    """Safely parses a Python literal, returning the raw string if it is not one."""
+    try:
+        return ast.literal_eval(value)
+    except Exception:
+        return value
+
+# Numbers as written by Python, so cells like '01234', 'nan' or '1_000' are not taken for numbers
+_NUMBER_LITERALS = {
+    int: re.compile(r'\s*[-+]?(?:0|[1-9][0-9]*)\s*'),
+    float: re.compile(r'\s*[-+]?(?:0|[1-9][0-9]*|(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|[0-9]+[eE][-+]?[0-9]+)\s*'),
+}
+
+def infer_type(sample):
+    """Returns the narrowest of int, float and object that fits all the sampled cells."""
+    for typ in (int, float):
+        if all(_NUMBER_LITERALS[typ].fullmatch(value) for value in sample):
+            return typ
+    return object
+
+def parse_column(column, typ):
+    """Parses the cells of a column as the given type. Cells that do not fit are parsed as literals."""
+    if typ in (int, float):
+        if all(_NUMBER_LITERALS[typ].fullmatch(value) for value in column):
+            return list(map(typ, column))
+    elif typ is str:
+        return list(column)
+    # Object columns are often categorical, so immutable results are reused for repeated cells
+    parsed = {}
+    values = []
+    for value in column:
+        if value in parsed:
+            values.append(parsed[value])
+        else:
+            true_val = parse_literal(value)
+            if type(true_val) in (int, float, str, bool, type(None)):
+                parsed[value] = true_val
+            values.append(true_val)
+    return values
+
+class CSVReader(OfflineReader):
+    # Number of rows used to infer the type of columns missing from the schema
+    INFER_ROWS = 100
+
+    def __init__(self, location_id, targets, schema=None, lazy=False, workers=1):
+        super().__init__(location_id, targets, lazy=lazy, workers=workers)
+        # Maps source ids to int, float, str or object (parsed as a literal)
+        self.schema = dict(schema) if schema is not None else {}
+        self._COLUMNS = {}
+
+        import sys
+        csv.field_size_limit(sys.maxsize)
+
+    def options(self):
+        return {'schema': self.schema}
+
+    def state(self):
+        state = super().state()
+        state['columns'] = self._COLUMNS
+        state['schema'] = self.schema
+        return state
+
+    def merge(self, state):
+        super().merge(state)
+        self._COLUMNS.update(state['columns'])
+        for source_id, typ in state['schema'].items():
+            if source_id not in self.schema:
+                self.schema[source_id] = typ
+
+    def load_target(self, target):
+        filename, timestep = target
+        if self.lazy:
+            self.index_file(filename, timestep)
+            return
+
+        with open(filename) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        self.add_rows(header[1:], rows, timestep)
+
+    def add_rows(self, source_ids, rows, timestep):
+        timestamps = [int(row[0]) / 1000 for row in rows]
+        columns = list(itertools.zip_longest(*rows)) if rows else [()] * (len(source_ids) + 1)
+        for source_id, column in zip(source_ids, columns[1:]):
+            if source_id is None:
+                continue
+            # Rows shorter than the header are padded with None, such cells are missing
+            cells = [(timestamp, value) for timestamp, value in zip(timestamps, column) if value is not None]
+            if source_id not in self.schema:
+                self.schema[source_id] = infer_type([value for _, value in cells[:self.INFER_ROWS]])
+            values = parse_column([value for _, value in cells], self.schema[source_id])
+            self.add_entries(source_id, [(timestamp, timestep, value) for (timestamp, _), value in zip(cells, values)])
+
+    def index_file(self, filename, timestep):
+        """Indexes the byte ranges of consecutive rows that fall into the same time bucket."""
+        with open(filename, 'rb') as f:
+            header_line = f.readline()
+            header = next(csv.reader([header_line.decode()]))
+            self._COLUMNS[filename] = header
+            offset = len(header_line)
+            span_start, span_bucket, span_timestamp = offset, None, None
+            for line in f:
+                try:
+                    timestamp = int(line.split(b',', 1)[0]) / 1000
+                except ValueError:
+                    # A quoted cell spanning several lines, the row continues
+                    offset += len(line)
+                    continue
+                bucket = timestamp // self.BUCKET
+                if bucket != span_bucket:
+                    if span_bucket is not None:
+                        for source_id in header[1:]:
+                            self.index(source_id, span_timestamp, timestep, (filename, timestep, span_start, offset))
+                    span_start, span_bucket, span_timestamp = offset, bucket, timestamp
+                offset += len(line)
+            if span_bucket is not None:
+                for source_id in header[1:]:
+                    self.index(source_id, span_timestamp, timestep, (filename, timestep, span_start, offset))
+
+    def load_locations(self, source_id, locations):
+        for filename, timestep, start, end in locations:
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                rows = list(csv.reader(io.StringIO(f.read(end - start).decode(), newline='')))
+            # Only the requested column is parsed
+            self.add_rows([source_id if column == source_id else None for column in self._COLUMNS[filename][1:]], rows, timestep)
+
+_JSON_TOKENS = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]|"')
+_JSON_STRING_VALUE = rb'\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*")'
+_JSON_NUMBER_VALUE = rb'\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)'
+
+def iter_json_spans(f, chunk_size=1 << 20):
+    """Yields the file offset and the raw bytes of every element of the top-level JSON array in a binary file.
+
+    Only brackets and strings are scanned, so elements are found without being parsed."""
+    buffer = b''
+    base = 0
+    position = 0
+    depth = 0
+    start = None
+    eof = False
+    while True:
+        match = _JSON_TOKENS.search(buffer, position)
+        if match is None or match.group() == b'"':
+            # A lone quote means that a string continues past the end of the buffer
+            if eof:
+                if match is not None:
+                    raise ValueError(f"Unterminated string at offset {base + match.start()}")
+                return
+            resume = len(buffer) if match is None else match.start()
+            # Keep only the unfinished element, or the unfinished string
+            cut = resume if start is None else start
+            buffer = buffer[cut:]
+            base += cut
+            position = resume - cut
+            if start is not None:
+                start = 0
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+
+        token = match.group()
+        position = match.end()
+        if token == b'[' or token == b'{':
+            if depth == 1:
+                start = match.start()
+            depth += 1
+        elif token == b']' or token == b'}':
+            depth -= 1
+            if depth == 1 and start is not None:
+                yield base + start, buffer[start:position]
+                start = None
+
+def iter_ndjson_spans(f):
+    """Yields the file offset and the raw bytes of every record in a binary newline-delimited JSON file.
+
+    A truncated last record, e.g., of a file that is still being written, is skipped."""
+    offset = 0
+    try:
+        for line in f:
+            if line.endswith(b'\n') and line.strip():
+                yield offset, line
+            offset += len(line)
+    except EOFError:
+        # A compressed file that was not closed
+        return
+
+def is_ndjson(filename):
+    return filename.endswith(('.ndjson', '.ndjson.gz', '.jsonl', '.jsonl.gz'))
+
+def open_json(filename):
+    """Opens a JSON or NDJSON file for binary reading, decompressing .gz files."""
+    return gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
+
+def iter_json_records(filename, f, chunk_size=1 << 20):
+    """Yields the offset and raw bytes of the records in an open JSON array or NDJSON file."""
+    if is_ndjson(filename):
+        return iter_ndjson_spans(f)
+    return iter_json_spans(f, chunk_size)
+
+def iter_json_array(filename, keep=None, chunk_size=1 << 20):
+    """Streams the elements of the JSON array, or the records of the NDJSON file, with \\x13 characters removed.
+
+    Raw elements for which `keep` returns False are discarded without being parsed."""
+    with open_json(filename) as f:
+        for _, raw in iter_json_records(filename, f, chunk_size):
+            if keep is None or keep(raw):
+                yield json.loads(raw.replace(b'\x13', b''))
+
+def location_filter(location_id, allow_empty=False):
+    """Returns a check on raw JSON that rejects elements which cannot belong to the location."""
+    if not location_id.isascii():
+        # Non-ASCII ids may be escaped in the file, so they cannot be matched as bytes
+        return None
+    needles = [json.dumps(location_id).encode()]
+    if allow_empty:
+        needles.append(b'""')
+    return lambda raw: any(needle in raw for needle in needles)
+
+class JSONArrayReader(OfflineReader):
+    """Base of the readers of JSON exports that hold an array of data packages."""
+
+    # Keys of the location id, source id, timestamp and timestep of a package
+    KEYS = ('location_id', 'source_id', 'timestamp', 'timestep')
+    # Timestamps are divided by this to get seconds
+    TIMESTAMP_SCALE = 1
+
+    def matches(self, location_id):
+        return self.location_id == location_id
+
+    def keep(self):
+        """Returns a check that rejects raw packages of other locations before they are parsed."""
+        return location_filter(self.location_id)
+
+    def fields(self, data_point):
+        """Returns the location id, source id, timestamp, timestep and measurements of a package."""
+        raise NotImplementedError("The reader is missing the fields method.")
+
+    def raw_fields(self, raw):
+        """Extracts the location id, source id, timestamp and timestep from a raw package without parsing it.
+
+        Returns None if any key is missing or ambiguous, e.g., because measurements contain the same key."""
+        fields = []
+        for key, pattern in zip(self.KEYS, (_JSON_STRING_VALUE, _JSON_STRING_VALUE, _JSON_NUMBER_VALUE, _JSON_NUMBER_VALUE)):
+            matches = re.findall(rb'"' + re.escape(key.encode()) + pattern, raw)
+            if len(matches) != 1:
+                return None
+            fields.append(json.loads(matches[0]))
+        fields[2] /= self.TIMESTAMP_SCALE
+        return fields
+
+    def add_data_point(self, data_point):
+        location_id, source_id, timestamp, timestep, measurements = self.fields(data_point)
+        if self.matches(location_id):
+            measurement_timestep = timestep / len(measurements)
+            self.add_entries(source_id, [(timestamp + measurement_timestep * i, measurement_timestep, measurement) for i, measurement in enumerate(measurements)])
+
+    def load_target(self, filename):
+        if self.lazy:
+            self.index_file(filename)
+            return
+
+        for data_point in iter_json_array(filename, self.keep()):
+            self.add_data_point(data_point)
+
+    def index_file(self, filename):
+        keep = self.keep()
+        with open_json(filename) as f:
+            for offset, raw in iter_json_records(filename, f):
+                if keep is not None and not keep(raw):
+                    continue
+                fields = self.raw_fields(raw)
+                if fields is None:
+                    fields = self.fields(json.loads(raw.replace(b'\x13', b'')))
+                location_id, source_id, timestamp, timestep = fields[:4]
+                if self.matches(location_id):
+                    self.index(source_id, timestamp, timestep, (filename, offset, len(raw)))
+
+    def load_locations(self, source_id, locations):
+        for filename, group in itertools.groupby(sorted(locations), key=lambda location: location[0]):
+            # Offsets are sorted, so compressed files are decompressed in a single forward pass
+            with open_json(filename) as f:
+                for _, offset, length in group:
+                    f.seek(offset)
+                    self.add_data_point(json.loads(f.read(length).replace(b'\x13', b'')))
+
+class JSONReader__SAAM(JSONArrayReader):
+    KEYS = ('LocationId', 'SourceId', 'Timestamp', 'Timestep')
+    # Data points in DB are stored with millisecond resolution
+    TIMESTAMP_SCALE = 1000
+
+    def fields(self, data_point):
+        return data_point['LocationId'], data_point['SourceId'], data_point['Data']['Timestamp'] / 1000, data_point['Data']['Timestep'], data_point['Data']['Measurements']
+
+class JSONReader(JSONArrayReader):
+    def matches(self, location_id):
+        return self.location_id == location_id or location_id == ''
+
+    def keep(self):
+        return location_filter(self.location_id, allow_empty=True)
+
+    def fields(self, data_point):
+        if 'location_id' not in data_point:
+            # Written by JSONWriter
+            return data_point['locationId'], data_point['sourceId'], data_point['timestamp'], data_point['timestep'], data_point['values']
+        return data_point['location_id'], data_point['source_id'], data_point['timestamp'], data_point['timestep'], data_point['values']
+
+
+class HTTPConnectionPool:
+    """Keeps persistent connections to a server, so requests do not pay for a new handshake each time."""
+
+    def __init__(self, host, connection_class=http.client.HTTPSConnection, size=2, timeout=None):
+        self.host = host
+        self.connection_class = connection_class
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, url, retries=1):
+        """Sends a request and returns the status and the body of the response.
+
+        If the request fails, e.g., because the server dropped the connection, the other idle connections
+        are likely dead as well. They are dropped and the request is retried on a new connection."""
+        connection = self._acquire()
+        for attempt in range(retries + 1):
+            try:
+                connection.request(method, url)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                # Timeouts are OSErrors too, the connection is in an unknown state after any of them
+                connection.close()
+                if attempt == retries:
+                    raise
+                self.close()
+                connection = self.connection_class(self.host, timeout=self.timeout)
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
 
 
 class HTTPReader(Reader):
+    CONNECTION_CLASSES = {
+        'HTTPS': http.client.HTTPSConnection,
+        'HTTP': http.client.HTTPConnection,
+    }
+
     def __init__(self, location_id, connection_settings):
         super().__init__()
         self.location_id = location_id
         self.settings = connection_settings
+        self.sensor_pool = None
+        self.other_pool = None
+        self.executor = None
 
     def load(self):
-        if self.settings['protocol'] == 'HTTPS':
-            self.sensor_connection = None
-            self.other_connection = None
-            pass
+        if self.settings['protocol'] in HTTPReader.CONNECTION_CLASSES:
+            connection_class = HTTPReader.CONNECTION_CLASSES[self.settings['protocol']]
+            max_in_flight = self.settings.get('max_in_flight', 4)
+            pool_size = self.settings.get('pool_size', max_in_flight)
+            timeout = self.settings.get('timeout', None)
+            self.sensor_pool = HTTPConnectionPool(self.settings['sensor_server'], connection_class, pool_size, timeout)
+            self.other_pool = HTTPConnectionPool(self.settings['other_server'], connection_class, pool_size, timeout)
+            if max_in_flight > 1:
+                self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix=str(self))
         else:
             raise NotImplementedError('Protocol not yet implemented: ' + self.settings['protocol'])
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.sensor_connection:
-            self.sensor_connection.close()
-        if self.other_connection:
-            self.other_connection.close()
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.sensor_pool:
+            self.sensor_pool.close()
+        if self.other_pool:
+            self.other_pool.close()
+        super().__exit__(exc_type, exc_val, exc_tb)
 
-    def query(self, source_id, start_time, end_time):
-        time_format = self.settings['time_format']
+    def chunks(self, source_id, start_time, end_time):
+        """Splits a request into the intervals that are queried separately."""
         time = start_time
         if source_id[:5] == "sens_":
+            # Sensor data is queried in chunks of at most 6 hours
             while time + 21600 < end_time:
-                self.query(source_id, time, time + 21600)
+                yield source_id, time, time + 21600
                 time += 21600
-        params = {'StartDate': f_timestamp(time), 'EndDate': f_timestamp(end_time)}
+        yield source_id, time, end_time
+
+    def request(self, source_id, start_time, end_time):
+        """Queries a single chunk and returns the parsed entries per source, without storing them."""
+        params = {'StartDate': f_timestamp(start_time), 'EndDate': f_timestamp(end_time)}
 
         if source_id[:5] == "sens_":
-            self.sensor_connection = http.client.HTTPSConnection(self.settings['sensor_server'])
             url = "/" + self.settings['sensor_query_url'].format(location_id=self.location_id, source_id=source_id) + "?" + urlencode(params)
 
             self.log(f"Querying sensor {url}", 4)
-            self.sensor_connection.request('GET', url)
-        
-            response = self.sensor_connection.getresponse()
+            status, r_data = self.sensor_pool.request('GET', url)
         else:
-            self.other_connection = http.client.HTTPSConnection(self.settings['other_server'])
             params['SourceId'] = source_id
             url = "/" + self.settings['other_query_url'].format(location_id=self.location_id, source_id=source_id) + "?" + urlencode(params)
 
             self.log(f"Querying other {url}", 4)
-            self.other_connection.request('GET', url)
-        
-            response = self.other_connection.getresponse()
+            status, r_data = self.other_pool.request('GET', url)
 
-        if response.status == 200:
-            r_data = response.read()
+        entries = []
+        if status == 200:
             data = json.loads(r_data)
             for data_point in data:
                 timestamp, source_id = data_point['data']['timestamp'] / 1000, data_point['sourceId'] # Data points in DB are stored with millisecond resolution
                 timestep = data_point['data']['timestep']
-                if source_id not in self._DATA:
-                    self._DATA[source_id] = {}
                 measurements = data_point['data']['measurements']
                 measurement_timestep = timestep / len(measurements)
-                for i, measurement in enumerate(measurements):
-                    m_timestamp = timestamp + measurement_timestep * i
-                    self._DATA[source_id][m_timestamp] = (m_timestamp, measurement_timestep, measurement)
-        elif response.status == 401:
+                entries.append((source_id, [(timestamp + measurement_timestep * i, measurement_timestep, measurement) for i, measurement in enumerate(measurements)]))
+        elif status == 401:
             # Unathenticated
             pass
         else:
-            raise ConnectionError(response.status)
+            raise ConnectionError(status)
+        return entries
 
+    def query_chunks(self, requests):
+        """Queries the chunks of all (source_id, start_time, end_time) requests, at most `max_in_flight` at once."""
+        chunks = [chunk for source_id, start_time, end_time in requests for chunk in self.chunks(source_id, start_time, end_time)]
+        if self.executor:
+            results = self.executor.map(lambda chunk: self.request(*chunk), chunks)
+        else:
+            results = map(lambda chunk: self.request(*chunk), chunks)
+        # Results are stored from this thread and in the order of the chunks
+        for entries in results:
+            for source_id, source_entries in entries:
+                self.add_entries(source_id, source_entries)
 
-        if self.sensor_connection:
-            self.sensor_connection.close()
-        if self.other_connection:
-            self.other_connection.close()
-        
+    def query(self, source_id, start_time, end_time):
+        self.query_chunks([(source_id, start_time, end_time)])
+
+    def query_many(self, requests):
+        self.query_chunks(requests)
+
+
+class CacheFileReader(Reader):
+    """Reads a binary cache file written by CachedReader, without loading it into memory."""
+
+    def __init__(self, location_id, filename):
+        super().__init__()
+        self.location_id = location_id
+        self.filename = filename
+        self.cache = None
+
+    def is_online(self):
+        return False
+
+    def load(self):
+        if self.cache is None:
+            self.cache = CacheFile(self.filename)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+    def query(self, source_id, start_time, end_time):
+        pass
+
+    def sources(self):
+        return self.cache.sources()
+
+    def entries(self, source_id):
+        return self.cache.range(source_id, None, None)
+
+    def __contains__(self, item):
+        return item in self.cache
+
+    def __getitem__(self, item):
+        source_id, target_time = item
+        if isinstance(target_time, slice):
+            return self.cache.range(source_id, target_time.start, target_time.stop)
+        elif source_id in self.cache.sources():
+            return [ self.cache.get(source_id, target_time) ]
+        else:
+            return []
 
 
 class CachedReader(Reader):
+    # The cache file is compacted once appended runs leave it with more segments than this
+    COMPACT_SEGMENTS = 16
+
     def __init__(self, cache_token, reader):
         super().__init__()
         self.location_id = reader.location_id
         self.cache_token = cache_token
-        if os.path.exists(f'cache/{self.cache_token}.json'):
-            self.reader = JSONReader(self.location_id, [f'cache/{self.cache_token}.json'])
-        else:
-            self.reader = reader
+        self.reader = reader
+        self.cache = None
+        if os.path.exists(self.cache_filename()):
+            self.cache = CacheFileReader(self.location_id, self.cache_filename())
+        # Intervals fetched from the wrapped reader during this run
+        self._FETCHED = {}
+
+    def cache_filename(self):
+        return f'cache/{self.cache_token}.pmc'
+
+    def set_logger(self, logger):
+        super().set_logger(logger)
+        self.reader.set_logger(logger)
+        if self.cache:
+            self.cache.set_logger(logger)
         
     def load(self):
         self.reader.__enter__()
-        self.reader.load()
+        if self.cache:
+            self.cache.load()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if not os.path.exists(f'cache/{self.cache_token}.json'):
-            dicts = []
-            for source_id in self.reader._DATA:
-                for timestamp, (timestamp, timestep, value) in self.reader._DATA[source_id].items():
-                    dicts.append(self.make_dict(source_id, timestamp, timestep, value))
-            filename = f"cache/{self.cache_token}.json"
-            with open(filename, 'w') as f:
-                s = json.dumps(dicts).replace('\x13', '')
-                f.write(s)
+        segments = 0
+        if self.cache:
+            segments = self.cache.cache.segments
+            self.cache.__exit__(exc_type, exc_val, exc_tb)
 
-        self.reader.__exit__(exc_type, exc_val, exc_tb)
+        if self._FETCHED:
+            # Only data fetched during this run is appended, the cached data is already in the file
+            os.makedirs('cache', exist_ok=True)
+            data = {source_id: self.reader.entries(source_id) for source_id in self.reader.sources()}
+            CacheFile.write(self.cache_filename(), data, self._FETCHED, append=True)
+            if segments + 1 > CachedReader.COMPACT_SEGMENTS:
+                CacheFile.compact(self.cache_filename())
 
-    def make_dict(self, source_id, timestamp, timestep, value):
-        o = {
-            'SourceId': source_id,
-            'LocationId': self.location_id,
-            'Data': {
-                'Timestamp': timestamp*1000,
-                'Timestep': timestep,
-                'Measurements': [undateify(value)]
-            }
-        }
-        return o
+        self.reader.__exit__(exc_type, exc_val, exc_tb)
+        super().__exit__(exc_type, exc_val, exc_tb)
 
     def is_online(self):
         return True
 
     def __contains__(self, item):
-        return super().__contains__(item) or item in self.reader
+        return super().__contains__(item) or item in self.reader or (self.cache is not None and item in self.cache)
 
     def query(self, source_id, start_time, end_time):
-        return self.reader.query(source_id, start_time, end_time)
+        self.query_many([(source_id, start_time, end_time)])
+
+    def query_many(self, requests):
+        # Only the ranges missing from the cache are forwarded to the wrapped reader
+        gaps = []
+        for source_id, start_time, end_time in requests:
+            coverage = self.cache.cache.coverage(source_id) if self.cache else IntervalSet()
+            gaps += [(source_id, start, end) for start, end in coverage.gaps(start_time, end_time)]
+        if gaps:
+            self.reader.query_many(gaps)
+        for source_id, start, end in gaps:
+            if source_id not in self._FETCHED:
+                self._FETCHED[source_id] = IntervalSet()
+            self._FETCHED[source_id].add(start, end)
 
     def __getitem__(self, item):
         source_id, target_time = item
-        values = []
         if source_id in self._DATA:
-            if isinstance(target_time, slice):
-                start = target_time.start
-                end = target_time.stop
-                values += [val for time, val in self._DATA[source_id].items() if start < time <= end]
-            else:
-                values += [ self._DATA[source_id][target_time] ]
-        elif source_id in self.reader._DATA:
-            if isinstance(target_time, slice):
-                start = target_time.start
-                end = target_time.stop
-                values += [val for time, val in self.reader._DATA[source_id].items() if start < time <= end]
-            else:
-                values += [ self.reader._DATA[source_id][target_time] ]
-        return sorted(values)
-
-   
-def undateify(val):
-    if type(val) == dict:
-        for k in val:
-            val[k] = undateify(val[k])
-        return val
-    elif type(val) == list:
-        return [undateify(x) for x in val]
-    elif type(val) == set:
-        return {undateify(x) for x in val}
-    elif type(val) not in [str, int, float, list, dict, set, bool, type(None)]:
-        return str(val)
-    else:
-        return val
+            return super().__getitem__(item)
+        if not isinstance(target_time, slice):
+            if self.cache is not None and item not in self.reader and item in self.cache:
+                return self.cache[item]
+            return self.reader[item]
+        cached = self.cache[item] if self.cache else []
+        fetched = self.reader[item]
+        if cached and fetched:
+            entries = {entry[0]: entry for entry in cached + fetched}
+            return [entries[timestamp] for timestamp in sorted(entries)]
+        else:
+            return cached or fetched
+
 
 class MultiReader:
     def __init__(self, *readers):
@@ -318,6 +1009,19 @@ class MultiReader:
     def set_logger(self, logger):
         for r in self._READERS:
             r.set_logger(logger)
+
+    def set_columnar(self, columnar=True):
+        for r in self._READERS:
+            r.set_columnar(columnar)
+
+    def set_memory_budget(self, budget, spill_directory=None, partition='1d'):
+        # The budget is split evenly between the readers
+        for r in self._READERS:
+            r.set_memory_budget(budget / len(self._READERS), spill_directory, partition)
+
+    def set_hot_windows(self, windows):
+        for r in self._READERS:
+            r.set_hot_windows(windows)
             
     def load(self):
         for r in self._READERS:
@@ -332,7 +1036,7 @@ class MultiReader:
     def __exit__(self, exc_type, exc_val, exc_tb):
         for r in self._READERS:
             try:
-                exit(r)
+                r.__exit__(exc_type, exc_val, exc_tb)
             except:
                 continue
 
@@ -359,6 +1063,18 @@ class MultiReader:
         for r in self._READERS:
             r.query(source_id, start_time, end_time)
 
+    def query_many(self, requests):
+        for r in self._READERS:
+            r.query_many(requests)
+
+    def fetch(self, source_id, start_time, end_time):
+        for r in self._READERS:
+            r.fetch(source_id, start_time, end_time)
+
+    def fetch_many(self, requests):
+        for r in self._READERS:
+            r.fetch_many(requests)
+
     def add_entries(self, source_id, entries):
         # inject the entries only into the first reader
         self._READERS[0].add_entries(source_id, entries)
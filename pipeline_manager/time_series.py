@@ -0,0 +1,287 @@
+import bisect
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class TimeSeries:
+    """Entries of a single source kept sorted by their timestamp.
+
+    Behaves like the `{timestamp: entry}` dicts previously used in `Reader._DATA`,
+    but answers range queries with a binary search instead of a full scan.
+    Out of order batches are appended and the timestamps are sorted again on the next read,
+    which keeps loading unsorted files linear."""
+
+    # Rough size of a stored entry (tuple, floats, dict slot and list slot)
+    ENTRY_BYTES = 200
+
+    def __init__(self, entries=()):
+        self._times = []
+        self._sorted = True
+        self._entries = {}
+        self.add(entries)
+
+    def _order(self):
+        if not self._sorted:
+            # Timsort merges the sorted runs of the appended batches
+            self._times.sort()
+            self._sorted = True
+        return self._times
+
+    def __len__(self):
+        return len(self._times)
+
+    def __iter__(self):
+        return iter(self._order())
+
+    def __contains__(self, timestamp):
+        return timestamp in self._entries
+
+    def __getitem__(self, timestamp):
+        return self._entries[timestamp]
+
+    def __setitem__(self, timestamp, entry):
+        if timestamp not in self._entries:
+            self._insert([timestamp])
+        self._entries[timestamp] = entry
+
+    def keys(self):
+        return iter(self._order())
+
+    def values(self):
+        return (self._entries[t] for t in self._order())
+
+    def items(self):
+        return ((t, self._entries[t]) for t in self._order())
+
+    def bounds(self, start, end):
+        """Returns the index range of timestamps in the interval (start, end]."""
+        times = self._order()
+        lo = 0 if start is None else bisect.bisect_right(times, start)
+        hi = len(times) if end is None else bisect.bisect_right(times, end)
+        return lo, hi
+
+    def range(self, start, end):
+        """Returns the sorted entries with a timestamp in the interval (start, end]."""
+        lo, hi = self.bounds(start, end)
+        entries = self._entries
+        return [entries[t] for t in self._times[lo:hi]]
+
+    def add(self, entries):
+        """Merges a batch of `(timestamp, timestep, value)` entries into the series."""
+        new = []
+        for entry in entries:
+            timestamp = entry[0]
+            if timestamp not in self._entries:
+                new.append(timestamp)
+            self._entries[timestamp] = entry
+        if new:
+            self._insert(new)
+
+    def _insert(self, timestamps):
+        timestamps.sort()
+        times = self._times
+        if self._sorted and times and timestamps[0] < times[-1]:
+            self._sorted = False
+        times.extend(timestamps)
+
+    def columns(self, start=None, end=None):
+        """Returns the timestamps, timesteps and values in the interval (start, end] as separate lists."""
+        entries = self.range(start, end)
+        return [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries]
+
+    def nbytes(self):
+        return len(self._times) * self.ENTRY_BYTES
+
+    def partitions(self, size):
+        """Yields the index and the number of entries of every non-empty partition of the given size."""
+        times = self._order()
+        lo = 0
+        while lo < len(times):
+            partition = times[lo] // size
+            hi = bisect.bisect_left(times, (partition + 1) * size, lo)
+            yield partition, hi - lo
+            lo = hi
+
+    def pop_range(self, start, end):
+        """Removes and returns the entries with a timestamp in the interval [start, end)."""
+        times = self._order()
+        lo = bisect.bisect_left(times, start)
+        hi = bisect.bisect_left(times, end)
+        entries = [self._entries.pop(t) for t in times[lo:hi]]
+        del times[lo:hi]
+        return entries
+
+
+class ColumnarTimeSeries:
+    """Numeric entries of a single source stored in contiguous NumPy arrays.
+
+    Range queries through `columns` return views into the arrays, so no data
+    is copied. A series stores either floats or ints in the int64 range, so values keep their type.
+    Use `accepts` to check whether a batch can be stored at all, and `matches` whether it can be added.
+    Like in TimeSeries, out of order batches are appended and sorted on the next read."""
+
+    def __init__(self, entries=()):
+        if np is None:
+            raise ImportError("Columnar storage requires numpy.")
+        self._t = np.empty(0, dtype=np.float64)
+        self._s = np.empty(0, dtype=np.float64)
+        self._v = np.empty(0, dtype=np.int64)
+        self._n = 0
+        self._sorted = True
+        self.add(entries)
+
+    def _order(self):
+        if not self._sorted:
+            # Stored entries come first, so the stable sort lets the newer ones win
+            t, s, v = _sorted_unique(self._t[:self._n], self._s[:self._n], self._v[:self._n])
+            self._t, self._s, self._v, self._n = t, s, v, len(t)
+            self._sorted = True
+
+    @staticmethod
+    def kind(entries):
+        """Returns the NumPy kind of the values in the batch, 'f' if all are floats, 'i' if all are ints
+        that fit into int64 and None otherwise."""
+        if all(type(entry[2]) is float for entry in entries):
+            return 'f'
+        if all(type(entry[2]) is int and -2**63 <= entry[2] < 2**63 for entry in entries):
+            return 'i'
+        return None
+
+    @staticmethod
+    def accepts(entries):
+        """Checks that the values in the batch can be stored in a single array without changing their type."""
+        return ColumnarTimeSeries.kind(entries) is not None
+
+    def matches(self, entries):
+        """Checks that the batch can be added to the series, i.e., that its values have the kind of the stored ones."""
+        entries = list(entries)
+        if not entries:
+            return True
+        kind = ColumnarTimeSeries.kind(entries)
+        return kind is not None and (self._n == 0 or kind == self._v.dtype.kind)
+
+    def __len__(self):
+        self._order()
+        return self._n
+
+    def __iter__(self):
+        self._order()
+        return iter(self._t[:self._n].tolist())
+
+    def _find(self, timestamp):
+        self._order()
+        i = int(np.searchsorted(self._t[:self._n], timestamp))
+        if i < self._n and self._t[i] == timestamp:
+            return i
+        return None
+
+    def __contains__(self, timestamp):
+        return self._find(timestamp) is not None
+
+    def __getitem__(self, timestamp):
+        i = self._find(timestamp)
+        if i is None:
+            raise KeyError(timestamp)
+        return (self._t[i].item(), self._s[i].item(), self._v[i].item())
+
+    def __setitem__(self, timestamp, entry):
+        self.add([(timestamp, entry[1], entry[2])])
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return iter(self.range(None, None))
+
+    def items(self):
+        return ((entry[0], entry) for entry in self.range(None, None))
+
+    def bounds(self, start, end):
+        """Returns the index range of timestamps in the interval (start, end]."""
+        self._order()
+        t = self._t[:self._n]
+        lo = 0 if start is None else int(np.searchsorted(t, start, side='right'))
+        hi = self._n if end is None else int(np.searchsorted(t, end, side='right'))
+        return lo, hi
+
+    def columns(self, start=None, end=None):
+        """Returns views of the timestamps, timesteps and values in the interval (start, end]."""
+        lo, hi = self.bounds(start, end)
+        return self._t[lo:hi], self._s[lo:hi], self._v[lo:hi]
+
+    def range(self, start, end):
+        """Returns the sorted entries with a timestamp in the interval (start, end]."""
+        t, s, v = self.columns(start, end)
+        return list(zip(t.tolist(), s.tolist(), v.tolist()))
+
+    def add(self, entries):
+        """Merges a batch of numeric `(timestamp, timestep, value)` entries into the series."""
+        entries = list(entries)
+        if not entries:
+            return
+        t, s, v = zip(*entries)
+        t = np.asarray(t, dtype=np.float64)
+        s = np.asarray(s, dtype=np.float64)
+        kind = ColumnarTimeSeries.kind(entries)
+        if kind is None or self._n and kind != self._v.dtype.kind:
+            raise TypeError("Columnar series only store ints or floats, without mixing them.")
+        v = np.asarray(v, dtype=np.float64 if kind == 'f' else np.int64)
+        if not self._n:
+            self._v = self._v.astype(v.dtype)
+
+        t, s, v = _sorted_unique(t, s, v)
+
+        n = self._n
+        if self._sorted and n and t[0] <= self._t[n - 1]:
+            self._sorted = False
+        self._reserve(n + len(t))
+        self._t[n:n + len(t)] = t
+        self._s[n:n + len(t)] = s
+        self._v[n:n + len(t)] = v
+        self._n += len(t)
+
+    def nbytes(self):
+        return self._t.nbytes + self._s.nbytes + self._v.nbytes
+
+    def partitions(self, size):
+        """Yields the index and the number of entries of every non-empty partition of the given size."""
+        self._order()
+        t = self._t[:self._n]
+        lo = 0
+        while lo < self._n:
+            partition = t[lo].item() // size
+            hi = int(np.searchsorted(t, (partition + 1) * size, side='left'))
+            yield partition, hi - lo
+            lo = hi
+
+    def pop_range(self, start, end):
+        """Removes and returns the entries with a timestamp in the interval [start, end)."""
+        self._order()
+        t = self._t[:self._n]
+        lo = int(np.searchsorted(t, start, side='left'))
+        hi = int(np.searchsorted(t, end, side='left'))
+        entries = list(zip(self._t[lo:hi].tolist(), self._s[lo:hi].tolist(), self._v[lo:hi].tolist()))
+        keep = np.r_[0:lo, hi:self._n]
+        self._t, self._s, self._v = self._t[keep], self._s[keep], self._v[keep]
+        self._n = len(keep)
+        return entries
+
+    def _reserve(self, size):
+        if size > len(self._t):
+            capacity = max(size, 2 * len(self._t), 16)
+            for name in ('_t', '_s', '_v'):
+                old = getattr(self, name)
+                new = np.empty(capacity, dtype=old.dtype)
+                new[:self._n] = old[:self._n]
+                setattr(self, name, new)
+
+
+def _sorted_unique(t, s, v):
+    """Sorts the columns by timestamp, keeping the last entry of duplicated timestamps."""
+    order = np.argsort(t, kind='stable')
+    t, s, v = t[order], s[order], v[order]
+    keep = np.append(t[1:] != t[:-1], True)
+    return t[keep], s[keep], v[keep]
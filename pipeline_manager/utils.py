@@ -1,5 +1,4 @@
-import re, datetime, pytz, sys
-from functools import cache
+import re, datetime, pytz, sys, bisect, queue, threading
 
 
 p = re.compile(r"(\d+)(d|h|m|s|ms)")
@@ -22,23 +21,100 @@ def get_callable(f):
             o = getattr(o, chunks.pop(0))
         return o
 
-def merge_intervals(intervals):
-    if intervals:
-        sort = sorted(list(intervals))
-        i = 0
-        merged = []
-        current = sort.pop(0)
-        while sort:
-            nxt = sort.pop(0)
-            if nxt[0] <= current[1]:
-                current = (current[0], max(current[1], nxt[1]))
-            elif nxt[0] > current[1]:
-                merged.append(current)
-                current = nxt
-        merged.append(current)
-        return merged
-    else:
-        return []
+class IntervalSet:
+    """A set of disjoint, sorted intervals. Touching intervals are merged."""
+
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __repr__(self):
+        return f"IntervalSet({list(self)})"
+
+    def add(self, start, end):
+        # Intervals ending before the start or starting after the end are not affected
+        lo = bisect.bisect_left(self._ends, start)
+        hi = bisect.bisect_right(self._starts, end)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def overlaps(self, start, end):
+        # The last interval starting before the end has the largest end of those
+        i = bisect.bisect_left(self._starts, end)
+        return i > 0 and self._ends[i - 1] > start
+
+    def gaps(self, start, end):
+        """Returns the parts of the interval (start, end) that are not covered."""
+        gaps = []
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while start < end and i < len(self._starts) and self._starts[i] < end:
+            if self._starts[i] > start:
+                gaps.append((start, self._starts[i]))
+            start = max(start, self._ends[i])
+            i += 1
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+def prefetch(iterable, size):
+    """Iterates over `iterable` in a background thread, keeping up to `size` items ready.
+
+    Useful to consume items of a network cursor while the next ones are still being fetched."""
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+            else:
+                put(done)
+        except BaseException as e:
+            put(done, e)
+        finally:
+            # Closes generators early, e.g., to release their cursors
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 def f_timestamp(timestamp : int):
@@ -53,8 +129,10 @@ def align_start_time(start_time, window, offset=0):
 def align_end_time(end_time, window, offset=0):
     return offset + ((end_time - offset) // window) * window
     
-@cache
 def get_profile():
+    """Returns the profile of the closest DataHandler on the call stack.
+
+    The profile is looked up on every call, since several managers may run in the same process."""
     from .data_handler import DataHandler
 
     try:
@@ -1,4 +1,4 @@
-import csv, datetime, json
+import csv, gzip, heapq, itertools, json, os
 
 class Writer:
     def __init__(self, location_id):
@@ -32,43 +32,161 @@ class Writer:
     def set_descriptor(self, descriptor):
         self.descriptor = descriptor
 
+class _TimespanFile:
+    """Rows of one timespan of a CSVWriter, written to the file as they are completed.
+
+    Once more than `buffer_size` rows are incomplete, the values of the oldest half are spilled to a
+    temporary file as a run sorted by timestamp. Closing merges the runs, so every timestamp still
+    ends up in a single row."""
+
+    # Number of spilled runs merged at once
+    MERGE_RUNS = 64
+
+    def __init__(self, filename, header, buffer_size):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        # Without a declared header, all rows are written when the file is closed and the columns are known
+        self.declared = header is not None
+        self.columns = {source_id: i for i, source_id in enumerate(header or [])}
+        self.rows = {}
+        # Offsets and lengths of the spilled runs
+        self.runs = []
+        self.part = None
+        self.file = None
+        if self.declared:
+            self.file = open(filename, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['timestamp'] + list(self.columns))
+
+    def add(self, source_id, timestamp, value):
+        if source_id not in self.columns:
+            if self.declared:
+                raise ValueError(f"Source {source_id} is not in the declared header of {self.filename}")
+            self.columns[source_id] = len(self.columns)
+        if timestamp not in self.rows:
+            self.rows[timestamp] = {}
+        row = self.rows[timestamp]
+        row[source_id] = value
+
+        if self.declared and len(row) == len(self.columns):
+            del self.rows[timestamp]
+            self.writer.writerow([timestamp] + [row[source_id] for source_id in self.columns])
+        elif len(self.rows) > self.buffer_size:
+            # The values of the oldest half of the rows are spilled, later values of the same timestamps are merged on close
+            evicted = sorted(itertools.islice(self.rows, len(self.rows) // 2))
+            self.spill([(timestamp, self.rows.pop(timestamp)) for timestamp in evicted])
+
+    def spill(self, rows):
+        if self.part is None:
+            self.part = open(self.filename + '.part', 'w+', newline='', encoding='utf-8')
+        writer = csv.writer(self.part)
+        self.part.seek(0, os.SEEK_END)
+        offset, length = self.part.tell(), 0
+        for timestamp, row in rows:
+            for source_id, value in row.items():
+                writer.writerow([timestamp, source_id, value])
+                length += 1
+        self.part.flush()
+        self.runs.append((offset, length))
+
+    def read_runs(self, runs):
+        """Yields the spilled values of the runs as (timestamp, source_id, value), ordered by timestamp.
+
+        Values of the same timestamp come in the order of the runs, so later values win."""
+        files = []
+        try:
+            iterators = []
+            for offset, length in runs:
+                f = open(self.filename + '.part', newline='', encoding='utf-8')
+                files.append(f)
+                f.seek(offset)
+                iterators.append(itertools.islice(csv.reader(f), length))
+            yield from heapq.merge(*iterators, key=lambda value: float(value[0]))
+        finally:
+            for f in files:
+                f.close()
+
+    def read_rows(self, runs):
+        """Yields the timestamps and the values of the rows merged from the runs, sorted by timestamp."""
+        for _, values in itertools.groupby(self.read_runs(runs), key=lambda value: float(value[0])):
+            values = list(values)
+            yield values[0][0], {source_id: value for _, source_id, value in values}
+
+    def merged_rows(self):
+        """Yields the timestamps and the values of all rows, merged from the spilled runs and sorted by timestamp."""
+        if not self.runs:
+            for timestamp in sorted(self.rows):
+                yield timestamp, self.rows[timestamp]
+            return
+
+        self.spill(sorted(self.rows.items()))
+        while len(self.runs) > self.MERGE_RUNS:
+            # Too many runs to read at once, groups of runs are merged into longer ones first
+            runs, self.runs = self.runs, []
+            for i in range(0, len(runs), self.MERGE_RUNS):
+                self.spill(self.read_rows(runs[i:i + self.MERGE_RUNS]))
+        yield from self.read_rows(self.runs)
+
+    def close(self):
+        try:
+            if self.declared:
+                columns = list(self.columns)
+            else:
+                # The columns are sorted once all of them are known
+                columns = sorted(self.columns)
+                self.file = open(self.filename, 'w', newline='')
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(['timestamp'] + columns)
+            for timestamp, row in self.merged_rows():
+                self.writer.writerow([timestamp] + [row.get(source_id, '') for source_id in columns])
+            self.rows = {}
+        finally:
+            self.file.close()
+            if self.part is not None:
+                self.part.close()
+                os.remove(self.filename + '.part')
+
+
 class CSVWriter(Writer):
-    def __init__(self, location_id, target):
+    def __init__(self, location_id, target, headers=None, buffer_size=10000):
         super().__init__(location_id)
         self.target = target
+        # Source ids of the columns, either a list for all timespans or a dict of lists per timespan.
+        # Without declared headers, the columns are collected while writing and sorted in a final pass.
+        self.headers = headers
+        # Number of incomplete rows kept in memory per timespan
+        self.buffer_size = buffer_size
+        self._FILES = {}
+
+    def header(self, timespan):
+        if isinstance(self.headers, dict):
+            return self.headers.get(timespan)
+        return self.headers
+
+    def add_entries(self, source_id, entries):
+        for timestamp, timespan, value in entries:
+            if timespan not in self._FILES:
+                filename = f"{self.descriptor}_{timespan}s.csv"
+                self._FILES[timespan] = _TimespanFile(f"{self.target}/{filename}", self.header(timespan), self.buffer_size)
+            self._FILES[timespan].add(source_id, timestamp, value)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        timespans = {}
-        headers = {}
-        for source_id in sorted(self._DATA.keys()):
-            for timestamp, (timestamp, timespan, value) in sorted(self._DATA[source_id].items()):
-                if timespan not in timespans:
-                    timespans[timespan] = {}
-                    headers[timespan] = []
-                if timestamp not in timespans[timespan]:
-                    timespans[timespan][timestamp] = {}
-                if source_id not in headers[timespan]:
-                    headers[timespan].append(source_id)
-                timespans[timespan][timestamp][source_id] = value
-
-        now = datetime.datetime.now()
-
-        for timespan in timespans:
-            filename = f"{self.descriptor}_{timespan}s.csv"
-            with open(f"{self.target}/{filename}", 'w') as f:
-                header = ['timestamp'] + headers[timespan]
-                writer = csv.DictWriter(f, fieldnames=header)
-                writer.writeheader()
-
-                for timestamp, values in timespans[timespan].items():
-                    values['timestamp'] = timestamp
-                    writer.writerow(values)
+        files, self._FILES = self._FILES, {}
+        for f in files.values():
+            f.close()
 
 
 class JSONWriter(Writer):
-    def __init__(self, location_id, target):
+    def __init__(self, location_id, target, ndjson=False, compress=False, flush_every=1000):
         super().__init__(location_id)
         self.target = target
+        # In NDJSON mode, every record is appended to the file as a line when it is added
+        self.ndjson = ndjson
+        self.compress = compress
+        # Number of NDJSON records after which the file is flushed
+        self.flush_every = flush_every
+        self.file = None
+        self._UNFLUSHED = 0
 
     def make_dict(self, source_id, timestamp, timestep, value):
         o = {
@@ -80,11 +198,37 @@ class JSONWriter(Writer):
         }
         return o
 
+    def filename(self):
+        if self.ndjson:
+            return f"{self.descriptor}.ndjson{'.gz' if self.compress else ''}".replace(':', '_')
+        return f"{self.descriptor}.json".replace(':', '_')
+
+    def add_entries(self, source_id, entries):
+        if not self.ndjson:
+            super().add_entries(source_id, entries)
+            return
+
+        if self.file is None:
+            path = f"{self.target}/{self.filename()}"
+            self.file = gzip.open(path, 'wt') if self.compress else open(path, 'w')
+        for timestamp, timestep, value in entries:
+            self.file.write(json.dumps(self.make_dict(source_id, timestamp, timestep, value)) + '\n')
+            self._UNFLUSHED += 1
+        if self._UNFLUSHED >= self.flush_every:
+            # Compressed files are flushed to a block boundary, so everything written so far can be read back
+            self.file.flush()
+            self._UNFLUSHED = 0
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.ndjson:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return
+
         dicts = []
         for source_id in self._DATA:
             for timestamp, (timestamp, timespan, value) in self._DATA[source_id].items():
                 dicts.append(self.make_dict(source_id, timestamp, timespan, value))
-        filename = f"{self.descriptor}.json".replace(':', '_')
-        with open(f"{self.target}/{filename}", 'w') as f:
+        with open(f"{self.target}/{self.filename()}", 'w') as f:
             json.dump(dicts, f)
@@ -0,0 +1,115 @@
+import os, tempfile, unittest
+
+from pipeline_manager.cache import CacheFile
+from pipeline_manager.readers import CachedReader, Reader
+
+
+class SourceReader(Reader):
+    """Returns an entry every 10 seconds and records the queried intervals."""
+
+    def __init__(self, location_id):
+        super().__init__()
+        self.location_id = location_id
+        self.queries = []
+
+    def query(self, source_id, start_time, end_time):
+        self.queries.append((source_id, start_time, end_time))
+        first = (start_time // 10 + 1) * 10
+        self.add_entries(source_id, [(t, 10, t // 10) for t in range(first, end_time + 1, 10)])
+
+
+class CacheFileTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'test.pmc')
+
+    def read(self):
+        cache = CacheFile(self.filename)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_round_trip(self):
+        data = {
+            'f': [(20.0, 10.0, 2.5), (10.0, 10.0, 1.5)],
+            'i': [(10.0, 10.0, 1), (20.0, 10.0, -2**63)],
+            'o': [(10.0, 10.0, 'a'), (20.0, 10.0, None), (30.0, 10.0, 2**70)],
+            'm': [(10.0, 10.0, 1), (20.0, 10.0, 2.5)],
+        }
+        CacheFile.write(self.filename, data, {'f': [(0, 20)], 'e': [(0, 100)]})
+        cache = self.read()
+        self.assertEqual(cache.segments, 1)
+        for source_id, entries in data.items():
+            self.assertEqual(cache.range(source_id, None, None), sorted(entries))
+        self.assertEqual([type(entry[2]) for entry in cache.range('m', None, None)], [int, float])
+        self.assertEqual(cache.get('i', 20.0), (20.0, 10.0, -2**63))
+        self.assertNotIn(('i', 30.0), cache)
+        # Intervals without any data are still covered
+        self.assertEqual(list(cache.coverage('e')), [(0, 100)])
+        self.assertEqual(cache.coverage('x').gaps(0, 10), [(0, 10)])
+
+    def test_append_and_compact(self):
+        CacheFile.write(self.filename, {'a': [(10.0, 10.0, 1), (20.0, 10.0, 2)]}, {'a': [(0, 20)]})
+        CacheFile.write(self.filename, {'a': [(20.0, 10.0, 'x'), (30.0, 10.0, 3)], 'b': [(10.0, 10.0, 1.5)]},
+                        {'a': [(20, 30)], 'b': [(0, 10)]}, append=True)
+
+        expected = [(10.0, 10.0, 1), (20.0, 10.0, 'x'), (30.0, 10.0, 3)]
+        cache = self.read()
+        self.assertEqual(cache.segments, 2)
+        # Later segments take precedence
+        self.assertEqual(cache.range('a', None, None), expected)
+        self.assertEqual(cache.get('a', 20.0), (20.0, 10.0, 'x'))
+        self.assertEqual(list(cache.coverage('a')), [(0, 30)])
+        cache.close()
+
+        CacheFile.compact(self.filename)
+        cache = self.read()
+        self.assertEqual(cache.segments, 1)
+        self.assertEqual(cache.range('a', None, None), expected)
+        self.assertEqual(cache.range('a', 10, 30), expected[1:])
+        self.assertEqual(cache.range('b', None, None), [(10.0, 10.0, 1.5)])
+        self.assertEqual(list(cache.coverage('a')), [(0, 30)])
+
+    def test_not_a_cache(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'something else')
+        with self.assertRaises(ValueError):
+            CacheFile(self.filename)
+
+
+class CachedReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        # Cache files are written relative to the working directory
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+
+    def run_reader(self, start_time, end_time):
+        source = SourceReader('A')
+        with CachedReader('A', source) as reader:
+            reader.fetch('s', start_time, end_time)
+            return source.queries, reader['s', start_time:end_time]
+
+    def test_gap_fetched(self):
+        queries, entries = self.run_reader(0, 50)
+        self.assertEqual(queries, [('s', 0, 50)])
+        self.assertEqual([entry[0] for entry in entries], [10, 20, 30, 40, 50])
+
+        # Only the part missing from the cache is fetched from the wrapped reader
+        queries, entries = self.run_reader(30, 80)
+        self.assertEqual(queries, [('s', 50, 80)])
+        self.assertEqual(entries, [(t, 10, t // 10) for t in range(40, 90, 10)])
+
+        queries, entries = self.run_reader(0, 80)
+        self.assertEqual(queries, [])
+        self.assertEqual([entry[0] for entry in entries], list(range(10, 90, 10)))
+        cache = CacheFile('cache/A.pmc')
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.segments, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""Checks the aggregation path of MongoReader against the package path, on an in-process MongoDB stand-in.
+
+Requires pymongo and mongomock, e.g., `pip install pymongo mongomock`."""
+import unittest
+from unittest import mock
+
+try:
+    import mongomock
+    from pipeline_manager import data_store
+    from pipeline_manager.mongo_accessors import MongoReader, MongoWriter, MAX_PACK_SPAN, SENSORS_COLLECTION_NAME, COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME
+except ImportError:
+    mongomock = None
+
+URL = 'mongodb://localhost/test'
+
+
+def package(location_id, source_id, timestamp, timestep, measurements):
+    return {
+        'LocationId': location_id,
+        'SourceId': source_id,
+        'Data': {'Timestamp': timestamp * 1000, 'Timestep': timestep, 'Measurements': measurements}
+    }
+
+
+@unittest.skipIf(mongomock is None, "requires pymongo and mongomock")
+class MongoTest(unittest.TestCase):
+    """Runs the data stores on mongomock, with clients shared only within a test."""
+
+    def setUp(self):
+        patcher = mock.patch.object(data_store, 'MongoClient', mongomock.MongoClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(data_store.close_clients)
+        data_store.close_clients()
+
+
+class AggregateTest(MongoTest):
+
+    def setUp(self):
+        super().setUp()
+
+        db = data_store.get_client(URL).get_database()
+        packages = []
+        for location_id, offset in (('A', 0), ('B', 7)):
+            for i in range(12):
+                # Packages of one to four samples, so the samples of a package have different timesteps
+                n = i % 4 + 1
+                measurements = [offset + 10 * i + j for j in range(n)]
+                packages.append(package(location_id, 'sens_x', 1000 + 240 * i, 240, measurements))
+                packages.append(package(location_id, 'sens_y', 1000 + 600 * i, 600, [float(m) for m in measurements]))
+            packages.append(package(location_id, 'sens_x', 5000, 60, []))
+        db[SENSORS_COLLECTION_NAME].insert_many(packages)
+        db[COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME].insert_many([
+            package('A', 'feat_z', 1000 + 3600 * i, 3600, [i]) for i in range(3)
+        ])
+
+        self.requests = [('sens_x', 1000, 2200), ('sens_x', 2500, 3880), ('sens_y', 1600, 6400), ('feat_z', 0, 10000)]
+
+    def fetch(self, location_id, aggregate):
+        reader = MongoReader(location_id, URL, batch_size=5, aggregate=aggregate)
+        reader.fetch_many(self.requests)
+        return reader
+
+    def test_sample_timestamps(self):
+        reader = self.fetch('A', True)
+        # The package at 1240 has two samples of 120 seconds, the one at 1480 three samples of 80 seconds
+        self.assertEqual(reader['sens_x', 1000:1700], [
+            (1240.0, 120.0, 10), (1360.0, 120.0, 11),
+            (1480.0, 80.0, 20), (1560.0, 80.0, 21), (1640.0, 80.0, 22)
+        ])
+
+    def test_samples_match_packages(self):
+        for location_id in ('A', 'B'):
+            packages, samples = self.fetch(location_id, False), self.fetch(location_id, True)
+            for source_id, start_time, end_time in self.requests:
+                self.assertEqual(samples[source_id, start_time:end_time], packages[source_id, start_time:end_time])
+
+    def test_samples_only_in_windows(self):
+        reader = self.fetch('A', True)
+        for source_id in reader.sources():
+            windows = [(start_time, end_time) for s, start_time, end_time in self.requests if s == source_id]
+            for timestamp, _, _ in reader[source_id, None:None]:
+                self.assertTrue(any(start_time < timestamp <= end_time for start_time, end_time in windows), (source_id, timestamp))
+
+    def test_fetch_locations(self):
+        for aggregate in (False, True):
+            readers = {MongoReader(location_id, URL, aggregate=aggregate): self.requests for location_id in ('A', 'B')}
+            MongoReader.fetch_locations(readers)
+            for reader in readers:
+                expected = self.fetch(reader.location_id, aggregate)
+                for source_id, start_time, end_time in self.requests:
+                    self.assertEqual(reader[source_id, start_time:end_time], expected[source_id, start_time:end_time])
+
+
+class PackTest(MongoTest):
+
+    def setUp(self):
+        super().setUp()
+        self.collection = data_store.get_client(URL).get_database()[COACHING_ADDITIONAL_DATA_SOURCES_COLLECTION_NAME]
+        self.entries = [(3600 * i, 3600, i) for i in range(1, 30)]
+
+    def write(self, batch_size):
+        with MongoWriter('A', URL, batch_size=batch_size, pack_size=4) as writer:
+            for entry in self.entries:
+                writer.add_entries('feat_x', [entry])
+        return sorted((d['Data']['Timestamp'], d['Data']['Measurements']) for d in self.collection.find({}, {'_id': False}))
+
+    def test_packages_aligned(self):
+        packages = self.write(1000)
+        self.assertEqual(packages[:2], [(3600 * 1000, [1, 2, 3]), (4 * 3600 * 1000, [4, 5, 6, 7])])
+        self.assertTrue(all(timestamp % (4 * 3600 * 1000) == 0 for timestamp, _ in packages[1:]))
+        # Flushing in smaller batches writes the same packages
+        self.collection.delete_many({})
+        self.assertEqual(self.write(5), packages)
+
+    def test_span_capped(self):
+        writer = MongoWriter('A', URL, pack_size=1000)
+        self.assertEqual(writer.pack_span(3600), MAX_PACK_SPAN)
+        self.assertEqual(writer.pack_span(7 * 24 * 3600), 7 * 24 * 3600)
+
+    def test_window_inside_package(self):
+        self.write(1000)
+        for aggregate in (False, True):
+            reader = MongoReader('A', URL, aggregate=aggregate, pack_span=4 * 3600)
+            reader.fetch('feat_x', 5 * 3600, 7 * 3600)
+            self.assertEqual(reader['feat_x', 5 * 3600:7 * 3600], [(6 * 3600.0, 3600.0, 6), (7 * 3600.0, 3600.0, 7)])
+        # Readers not told about the packing only find the packages starting in the window
+        reader = MongoReader('A', URL)
+        reader.fetch('feat_x', 5 * 3600, 7 * 3600)
+        self.assertEqual(reader['feat_x', 5 * 3600:7 * 3600], [])
+
+
+class CollectionNamesTest(MongoTest):
+
+    def setUp(self):
+        super().setUp()
+        self.db = data_store.get_client(URL).get_database()
+        self.db['Other'].insert_one({})
+
+    def test_archive_created_later(self):
+        self.assertIsNone(data_store.SensorsDataStore('Sensors', URL).archive_collection)
+        archive = data_store.archive_collection_name('Sensors', data_store.datetime.utcnow())
+        self.db[archive].insert_one({})
+
+        # The listing is only repeated once it is old enough
+        self.assertIsNone(data_store.SensorsDataStore('Sensors', URL).archive_collection)
+        with mock.patch.object(data_store, 'COLLECTION_NAMES_TTL', 0):
+            self.assertEqual(data_store.SensorsDataStore('Sensors', URL).archive_collection.name, archive)
+
+    def test_archive_name(self):
+        self.assertEqual(data_store.archive_collection_name('Sensors', data_store.datetime(2026, 3, 5)), 'Sensors-2026-2')
+        self.assertEqual(data_store.archive_collection_name('Sensors', data_store.datetime(2026, 1, 5)), 'Sensors-2025-12')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from unittest import mock
+
+from pipeline_manager import plan
+from pipeline_manager.plan import PipelinePlan
+
+
+def make_pipeline(k):
+    def scale(timestamp, timestep, inputs):
+        return [(timestamp, timestep, k)]
+    features = {'feat_a_1h': {'window': '1h', 'inputs': [('sens_a', '1h')], 'function': scale}}
+    pipeline = {'name': 'test', 'recurrence': '1h', 'outputs': ['feat_a_1h']}
+    return pipeline, features
+
+
+class PlanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(plan, '_PLANS', plan.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reused(self):
+        pipeline, features = make_pipeline(1)
+        self.assertIs(PipelinePlan.get(pipeline, features), PipelinePlan.get(pipeline, dict(features)))
+
+    def test_bounded(self):
+        # Functions created on the fly make a new plan every time
+        with mock.patch.object(plan, 'MAX_PLANS', 3):
+            first = make_pipeline(0)
+            first_plan = PipelinePlan.get(*first)
+            for k in range(1, 6):
+                PipelinePlan.get(*make_pipeline(k))
+                # The first plan stays as it is the most recently used one
+                self.assertIs(PipelinePlan.get(*first), first_plan)
+            self.assertEqual(len(plan._PLANS), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import http.client, http.server, socket, threading, unittest
+
+from pipeline_manager.readers import HTTPConnectionPool, infer_type, parse_column
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.append(self.connection)
+
+    def do_GET(self):
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.connections = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.pool = HTTPConnectionPool(f'127.0.0.1:{self.server.server_port}', http.client.HTTPConnection, size=2, timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def drop_connections(self):
+        with self.server.lock:
+            for connection in self.server.connections:
+                connection.shutdown(socket.SHUT_RDWR)
+
+    def test_connection_reused(self):
+        for i in range(3):
+            self.assertEqual(self.pool.request('GET', f'/{i}'), (200, f'/{i}'.encode()))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_reconnect_after_drop(self):
+        # Two connections are left idle in the pool
+        connections = [self.pool._acquire(), self.pool._acquire()]
+        for connection in connections:
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            self.pool._release(connection)
+        self.assertEqual(len(self.server.connections), 2)
+
+        self.drop_connections()
+        self.assertEqual(self.pool.request('GET', '/a'), (200, b'/a'))
+        # The other dead connection was dropped as well, the next requests reuse the new one
+        self.assertEqual(self.pool.request('GET', '/b'), (200, b'/b'))
+        self.assertEqual(len(self.server.connections), 3)
+
+
+class InferTypeTest(unittest.TestCase):
+
+    def test_numbers(self):
+        self.assertIs(infer_type(['1', '-20', '+3', '0']), int)
+        self.assertIs(infer_type(['1', '2.5', '1e3', '.5', '-0.25E-2']), float)
+        self.assertEqual(parse_column(['1', '2.5'], float), [1.0, 2.5])
+
+    def test_strings_kept(self):
+        for cells in (['01234', '1'], ['1', 'nan'], ['inf'], ['1_000'], ['0x10'], ['1', 'a']):
+            self.assertIs(infer_type(cells), object, cells)
+        self.assertEqual(parse_column(['01234', '1', 'a'], object), ['01234', 1, 'a'])
+
+    def test_cells_not_fitting(self):
+        # Cells past the sample are checked as well and parsed as literals if they do not fit
+        self.assertEqual(parse_column(['1', '01234'], int), [1, '01234'])
+        self.assertEqual(parse_column(['1.5', 'nan'], float), [1.5, 'nan'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from pipeline_manager.readers import Reader
+from pipeline_manager.time_series import TimeSeries, ColumnarTimeSeries, np
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def test_sorted(self):
+        series = TimeSeries([(30, 10, 'c'), (10, 10, 'a')])
+        series.add([(20, 10, 'b'), (40, 10, 'd')])
+        series[5] = (5, 5, 'z')
+        self.assertEqual(list(series), [5, 10, 20, 30, 40])
+        self.assertEqual(len(series), 5)
+
+    def test_replaced(self):
+        series = TimeSeries([(10, 10, 'a'), (20, 10, 'b')])
+        series.add([(10, 10, 'x')])
+        self.assertEqual(list(series.values()), [(10, 10, 'x'), (20, 10, 'b')])
+
+    def test_range(self):
+        series = TimeSeries([(t, 10, t) for t in (50, 10, 40, 20, 30)])
+        # Ranges include the end but not the start
+        self.assertEqual([e[0] for e in series.range(10, 40)], [20, 30, 40])
+        self.assertEqual([e[0] for e in series.range(None, 20)], [10, 20])
+        self.assertEqual([e[0] for e in series.range(35, None)], [40, 50])
+        self.assertEqual(series.range(50, 60), [])
+        self.assertEqual(series.columns(10, 30), ([20, 30], [10, 10], [20, 30]))
+
+    def test_pop_range(self):
+        series = TimeSeries([(t, 10, t) for t in range(0, 100, 10)])
+        self.assertEqual([e[0] for e in series.pop_range(20, 50)], [20, 30, 40])
+        self.assertEqual(list(series), [0, 10, 50, 60, 70, 80, 90])
+        self.assertNotIn(30, series)
+        self.assertEqual(list(series.partitions(50)), [(0, 2), (1, 5)])
+
+
+@unittest.skipIf(np is None, "requires numpy")
+class ColumnarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = Reader()
+        self.reader.set_columnar()
+
+    def test_kind(self):
+        self.assertEqual(ColumnarTimeSeries.kind([(1, 60, 1.5), (2, 60, 2.0)]), 'f')
+        self.assertEqual(ColumnarTimeSeries.kind([(1, 60, 1), (2, 60, -2**63)]), 'i')
+        self.assertIsNone(ColumnarTimeSeries.kind([(1, 60, 2**63)]))
+        self.assertIsNone(ColumnarTimeSeries.kind([(1, 60, 1), (2, 60, 2.0)]))
+        self.assertIsNone(ColumnarTimeSeries.kind([(1, 60, True)]))
+
+    def test_large_ints(self):
+        self.reader.add_entries('c', [(1, 1, 2**70)])
+        self.assertIsInstance(self.reader._DATA['c'], TimeSeries)
+        self.assertEqual(self.reader['c', 0:1], [(1, 1, 2**70)])
+
+    def test_types_kept(self):
+        self.reader.add_entries('i', [(1, 60, 3)])
+        self.assertIsInstance(self.reader._DATA['i'], ColumnarTimeSeries)
+        self.reader.add_entries('i', [(2, 60, 2.5)])
+        self.assertEqual([type(entry[2]) for entry in self.reader['i', 0:2]], [int, float])
+
+        self.reader.add_entries('f', [(1, 60, 1.5)])
+        self.reader.add_entries('f', [(2, 60, 2.0)])
+        self.assertIsInstance(self.reader._DATA['f'], ColumnarTimeSeries)
+        self.assertEqual(self.reader['f', 0:2], [(1.0, 60.0, 1.5), (2.0, 60.0, 2.0)])
+
+    def test_add_mismatch(self):
+        series = ColumnarTimeSeries([(1, 60, 1)])
+        self.assertFalse(series.matches([(2, 60, 1.5)]))
+        with self.assertRaises(TypeError):
+            series.add([(2, 60, 1.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from pipeline_manager.readers import Reader
+from pipeline_manager.utils import IntervalSet
+
+
+class IntervalSetTest(unittest.TestCase):
+
+    def test_touching_merged(self):
+        intervals = IntervalSet([(0, 10), (20, 30)])
+        intervals.add(10, 20)
+        self.assertEqual(list(intervals), [(0, 30)])
+
+    def test_overlapping_merged(self):
+        intervals = IntervalSet([(0, 10), (20, 30), (40, 50)])
+        intervals.add(5, 45)
+        self.assertEqual(list(intervals), [(0, 50)])
+        intervals.add(60, 70)
+        intervals.add(55, 65)
+        self.assertEqual(list(intervals), [(0, 50), (55, 70)])
+
+    def test_inside_kept(self):
+        intervals = IntervalSet([(0, 10)])
+        intervals.add(2, 8)
+        self.assertEqual(list(intervals), [(0, 10)])
+
+    def test_open_bounds(self):
+        # Intervals are open at the start, so touching intervals do not overlap
+        intervals = IntervalSet([(10, 20)])
+        self.assertFalse(intervals.overlaps(0, 10))
+        self.assertFalse(intervals.overlaps(20, 30))
+        self.assertTrue(intervals.overlaps(19, 30))
+        self.assertTrue(intervals.overlaps(0, 11))
+        self.assertEqual(intervals.gaps(0, 10), [(0, 10)])
+
+    def test_gaps(self):
+        intervals = IntervalSet([(10, 20), (30, 40)])
+        self.assertEqual(intervals.gaps(0, 50), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(intervals.gaps(15, 35), [(20, 30)])
+        self.assertEqual(intervals.gaps(12, 18), [])
+        self.assertEqual(intervals.gaps(25, 28), [(25, 28)])
+        self.assertEqual(IntervalSet().gaps(0, 5), [(0, 5)])
+
+
+class RecordingReader(Reader):
+
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def query(self, source_id, start_time, end_time):
+        self.queries.append((source_id, start_time, end_time))
+
+
+class FetchTest(unittest.TestCase):
+
+    def test_only_gaps_queried(self):
+        reader = RecordingReader()
+        reader.fetch('a', 10, 20)
+        reader.fetch('a', 30, 40)
+        reader.fetch('a', 0, 50)
+        self.assertEqual(reader.queries, [('a', 10, 20), ('a', 30, 40), ('a', 0, 10), ('a', 20, 30), ('a', 40, 50)])
+        reader.fetch('a', 5, 45)
+        self.assertEqual(len(reader.queries), 5)
+
+    def test_sources_covered_apart(self):
+        reader = RecordingReader()
+        reader.fetch_many([('a', 0, 10), ('a', 5, 15), ('b', 0, 10)])
+        self.assertEqual(reader.queries, [('a', 0, 15), ('b', 0, 10)])
+        reader.fetch('b', 5, 20)
+        self.assertEqual(reader.queries[-1], ('b', 10, 20))
+
+
+if __name__ == '__main__':
+    unittest.main()